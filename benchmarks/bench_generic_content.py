@@ -0,0 +1,98 @@
+"""
+Benchmark for rendering injected content from sources that have no wrapping
+element, comparing _get_generic_content() with the original line-by-line
+implementation on large flat sources, e.g.
+
+    python benchmarks/bench_generic_content.py --lines 20000
+"""
+
+import argparse
+import io
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motionscene_merger.scenemerge import (  # noqa: E402
+    IGNORED_LINES,
+    _get_generic_content,
+)
+
+log = logging.getLogger('motionscene_merger.scenemerge')
+log.setLevel(logging.WARNING)
+
+
+def legacy_get_generic_content(text: str, indent) -> str:
+    content = ''
+    for line in io.StringIO(text):
+        stripped = _legacy_stripped(line)
+        if stripped:
+            content = content + f'{" " * indent}{stripped}'
+
+    return content
+
+
+def _legacy_stripped(line):
+    for ignored in IGNORED_LINES:
+        if ignored in line:
+            content = line.replace(ignored, '').strip()
+            if content:
+                log.info(f'{line.strip()} -> {content}')
+                return content
+            else:
+                return None
+
+    return line
+
+
+def generate_source(lines: int, ignored: bool) -> str:
+    """Return a flat ConstraintSet with the given number of lines, optionally with namespace declarations."""
+    header = '<?xml version="1.0" encoding="utf-8"?>\n' if ignored else ''
+    body = ''.join(
+        f'    <Constraint android:id="@+id/view_{n}" android:layout_width="match_parent"/>\n'
+        for n in range(lines)
+    )
+    if ignored:
+        return (
+            f'{header}<ConstraintSet\n'
+            '    xmlns:android="http://schemas.android.com/apk/res/android"\n'
+            '    xmlns:motion="http://schemas.android.com/apk/res-auto">\n'
+            f'{body}</ConstraintSet>\n'
+        )
+    return f'<ConstraintSet>\n{body}</ConstraintSet>\n'
+
+
+def _time(fn, text: str, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text, 4)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark _get_generic_content against the original implementation.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 50000], help='Source sizes in lines.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to run each benchmark.')
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    print(f'{"lines":>8}{"ignored":>10}{"legacy":>12}{"current":>12}{"speedup":>10}')
+    for lines in args.lines:
+        for ignored in [False, True]:
+            text = generate_source(lines, ignored)
+            assert _get_generic_content(text, 4) == legacy_get_generic_content(text, 4)
+
+            before = _time(legacy_get_generic_content, text, args.repeat)
+            after = _time(_get_generic_content, text, args.repeat)
+            print(f'{lines:>8}{str(ignored):>10}{before * 1000:>10.2f}ms{after * 1000:>10.2f}ms{before / after:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark for the engines used to find <inject/> tags, comparing the default
+regex scanner with the XML parser on a synthetic corpus, e.g.
+
+    python benchmarks/bench_parser.py --files 1000 --size 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_scenemerge import generate_corpus  # noqa: E402
+from motionscene_merger import xmlparser  # noqa: E402
+from motionscene_merger.scenemerge import _scan  # noqa: E402
+
+PARSERS = {
+    'regex': _scan,
+    'xml': xmlparser.scan,
+}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the scenemerge parsers against a synthetic corpus.')
+    parser.add_argument('--files', type=int, default=200, help='Total number of source files.')
+    parser.add_argument('--fanout', type=int, default=3, help='Number of <inject/> tags in each non-leaf file.')
+    parser.add_argument('--size', type=int, default=20, help='Lines of content in each file.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to run each benchmark.')
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        xml_dir = generate_corpus(root, files=args.files, fanout=args.fanout, size=args.size)
+        texts = []
+        for filename in sorted(os.listdir(xml_dir)):
+            with open(os.path.join(xml_dir, filename), 'r') as f:
+                texts.append(f.read())
+
+    corpus_bytes = sum(len(x.encode('utf-8')) for x in texts)
+    print(f'{len(texts)} files, {corpus_bytes / 1024:.0f}KB, {args.repeat} runs')
+    print(f'{"parser":<10}{"median":>12}{"MB/s":>10}')
+    for name, scan in PARSERS.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for text in texts:
+                scan(text)
+            times.append(time.perf_counter() - start)
+
+        median = statistics.median(times)
+        print(f'{name:<10}{median * 1000:>10.2f}ms{corpus_bytes / median / 1024 / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
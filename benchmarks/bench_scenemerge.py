@@ -0,0 +1,291 @@
+"""
+Benchmarks for scenemerge using synthetic MotionScene corpora.
+
+Generates a res/xml tree with a configurable number of files, fan-out, nesting
+depth, file size and proportion of shared leaves, then times each phase of a
+merge separately. Results can be written as JSON and compared with a previous
+run to catch scaling regressions, e.g.
+
+    python benchmarks/bench_scenemerge.py --files 1000 --json before.json
+    (make some changes)
+    python benchmarks/bench_scenemerge.py --files 1000 --json after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import (
+    Dict,
+    List,
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motionscene_merger.scenemerge import (  # noqa: E402
+    SourceFile,
+    SourceGraph,
+    _build_sourcemap,
+    _find_source_sets,
+    _fragment_cache,
+    _get_output_filename,
+    _merge_source_set,
+    _render_output,
+    _write_if_changed,
+)
+
+logging.getLogger('motionscene_merger.scenemerge').setLevel(logging.WARNING)
+
+PHASES = [
+    'discovery',  # Finding source files.
+    'load',  # Reading source files.
+    'resolve',  # Resolving all <inject/> tags.
+    'write',  # Writing outputs to an empty directory.
+    'write_unchanged',  # Writing outputs which are already up to date.
+    'total',  # A complete merge of the sourceset.
+]
+
+MOTION_SCENE_HEADER = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<MotionScene xmlns:android="http://schemas.android.com/apk/res/android"\n'
+    '    xmlns:motion="http://schemas.android.com/apk/res-auto">\n'
+)
+GENERIC_HEADER = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<ConstraintSet xmlns:android="http://schemas.android.com/apk/res/android"\n'
+    '    xmlns:motion="http://schemas.android.com/apk/res-auto">\n'
+)
+
+
+def generate_corpus(
+        root: str,
+        files: int = 200,
+        fanout: int = 3,
+        depth: int = 4,
+        size: int = 20,
+        shared: float = 0.2,
+        seed: int = 0,
+) -> str:
+    """
+    Write a synthetic sourceset under root and return its res/xml directory.
+
+    files: Total number of source files.
+    fanout: Number of <inject/> tags in each non-leaf file.
+    depth: Number of levels of nested injection below the top-level scenes.
+    size: Number of lines of filler content in each file.
+    shared: Proportion of files which are shared leaves, and the probability
+            that any <inject/> tag refers to one of them.
+    """
+    rng = random.Random(seed)
+    xml_dir = os.path.join(root, 'app', 'src', 'main', 'res', 'xml')
+    os.makedirs(xml_dir, exist_ok=True)
+
+    shared_leaves = [f'_shared_{n}' for n in range(int(files * shared) if shared > 0 else 0)]
+    levels: List[List[str]] = [[] for _ in range(depth + 1)]
+    for n in range(files - len(shared_leaves)):
+        level = n % (depth + 1)
+        levels[level].append(f'_scene_{n}' if level == 0 else f'_part_{level}_{n}')
+
+    def _write(name: str, n: int, injects: List[str]):
+        lines = [
+            f'        <Constraint android:id="@+id/view_{n}_{x}" android:layout_width="match_parent"/>\n'
+            for x in range(size)
+        ]
+        lines += [f'    <inject src="{x}"/>\n' for x in injects]
+
+        style = n % 3
+        if style == 0:
+            content = MOTION_SCENE_HEADER + ''.join(lines) + '</MotionScene>\n'
+        elif style == 1:
+            content = '<merge>\n' + ''.join(lines) + '</merge>\n'
+        else:
+            content = GENERIC_HEADER + ''.join(lines) + '</ConstraintSet>\n'
+
+        with open(os.path.join(xml_dir, f'{name}.xml'), 'w') as f:
+            f.write(content)
+
+    n = 0
+    for level, names in enumerate(levels):
+        children = levels[level + 1] if level < depth else []
+        for name in names:
+            injects = []
+            if children or shared_leaves:
+                for _ in range(fanout):
+                    if shared_leaves and (not children or rng.random() < shared):
+                        injects.append(rng.choice(shared_leaves))
+                    else:
+                        injects.append(rng.choice(children))
+            _write(name, n, injects)
+            n += 1
+
+    for name in shared_leaves:
+        _write(name, n, [])
+        n += 1
+
+    return xml_dir
+
+
+@contextmanager
+def _timer(timings: Dict[str, float], phase: str):
+    # Every phase starts without any fragments rendered by an earlier phase or run.
+    _fragment_cache.clear()
+    start = time.perf_counter()
+    yield
+    timings[phase] = time.perf_counter() - start
+
+
+def run_once(root: str) -> Dict[str, float]:
+    timings = {}
+    output_dir = os.path.join(root, 'output')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    with _timer(timings, 'discovery'):
+        source_set = _find_source_sets(root, ['main'], 'xml')[0]
+
+    with _timer(timings, 'load'):
+        source_files = [SourceFile(path) for path in source_set.filepaths]
+
+    with _timer(timings, 'resolve'):
+        sources = _build_sourcemap(source_files)
+        graph = SourceGraph(sources)
+        for i in graph.order():
+            graph.files[i].resolve_injections(sources)
+
+    outputs = [f for f in source_files if not f.is_injected]
+    for phase in ['write', 'write_unchanged']:
+        with _timer(timings, phase):
+            for src in outputs:
+                _write_if_changed(os.path.join(output_dir, _get_output_filename(src)), _render_output(src))
+
+    shutil.rmtree(source_set.output_dir)
+    shutil.copytree(os.path.join(root, 'sources'), source_set.output_dir)
+    with _timer(timings, 'total'):
+        _merge_source_set(source_set)
+
+    return timings
+
+
+def run(args) -> dict:
+    params = {
+        'files': args.files,
+        'fanout': args.fanout,
+        'depth': args.depth,
+        'size': args.size,
+        'shared': args.shared,
+        'seed': args.seed,
+    }
+
+    with tempfile.TemporaryDirectory() as root:
+        xml_dir = generate_corpus(root, **params)
+        shutil.copytree(xml_dir, os.path.join(root, 'sources'))
+        corpus_bytes = sum(os.path.getsize(os.path.join(xml_dir, x)) for x in os.listdir(xml_dir))
+
+        runs = [run_once(root) for _ in range(args.repeat)]
+
+    results = {}
+    for phase in PHASES:
+        values = [r[phase] for r in runs]
+        results[phase] = {
+            'min': min(values),
+            'median': statistics.median(values),
+        }
+
+    return {
+        'params': params,
+        'corpus_bytes': corpus_bytes,
+        'repeat': args.repeat,
+        'python': platform.python_version(),
+        'commit': _get_commit(),
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Print a comparison of median timings and return the phases which regressed."""
+    if current['params'] != baseline['params']:
+        print('Warning: benchmark parameters differ from baseline')
+
+    regressions = []
+    print(f'{"phase":<18}{"baseline":>12}{"current":>12}{"change":>10}')
+    for phase in PHASES:
+        if phase not in baseline['results']:
+            continue
+        before = baseline['results'][phase]['median']
+        after = current['results'][phase]['median']
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(phase)
+            flag = '  REGRESSION'
+        print(f'{phase:<18}{before * 1000:>10.2f}ms{after * 1000:>10.2f}ms{change:>+10.1%}{flag}')
+    return regressions
+
+
+def _get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ''
+
+
+def _print_results(report: dict):
+    print(f'{report["params"]}, {report["corpus_bytes"] / 1024:.0f}KB, {report["repeat"]} runs')
+    print(f'{"phase":<18}{"min":>12}{"median":>12}')
+    for phase, values in report['results'].items():
+        print(f'{phase:<18}{values["min"] * 1000:>10.2f}ms{values["median"] * 1000:>10.2f}ms')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark scenemerge against a synthetic corpus.')
+    parser.add_argument('--files', type=int, default=200, help='Total number of source files.')
+    parser.add_argument('--fanout', type=int, default=3, help='Number of <inject/> tags in each non-leaf file.')
+    parser.add_argument('--depth', type=int, default=4, help='Levels of nested injection.')
+    parser.add_argument('--size', type=int, default=20, help='Lines of content in each file.')
+    parser.add_argument('--shared', type=float, default=0.2, help='Proportion of shared leaf files (0-1).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to run each benchmark.')
+    parser.add_argument('--json', type=str, help='Write results to this file.')
+    parser.add_argument('--compare', type=str, help='Compare results with a previous --json file.')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='With --compare, exit with an error if any phase is slower by more than this proportion.',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    report = run(args)
+    _print_results(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print()
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
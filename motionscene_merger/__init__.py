@@ -0,0 +1,22 @@
+from motionscene_merger.storage import (
+    FileStorage,
+    MemoryStorage,
+    Storage,
+)
+
+__all__ = [
+    'FileStorage',
+    'InjectionCycleError',
+    'MemoryStorage',
+    'Storage',
+    'merge',
+]
+
+
+def __getattr__(name: str):
+    # scenemerge is only imported when first used, so that `python -m motionscene_merger.scenemerge`
+    # runs a single copy of the module instead of one imported here and another as __main__.
+    if name in ('InjectionCycleError', 'merge'):
+        from motionscene_merger import scenemerge
+        return getattr(scenemerge, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,3 @@
+from motionscene_merger import scenemerge
+
+scenemerge.main()
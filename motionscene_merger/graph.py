@@ -0,0 +1,287 @@
+"""
+Inspect the <inject/> dependency graph of a sourceset without merging anything.
+
+    scenemerge graph . --format dot > graph.dot
+    scenemerge graph . --rdeps _example_constraintset.xml
+    scenemerge graph . --hotspots
+
+Each source file is scanned once for its <inject/> tags. --rdeps lists the
+outputs that would be rebuilt if the given source changed. --hotspots lists
+the shared files which affect the most outputs, with how many files inject
+them directly (fan-in) and how deeply nested their own injections are (depth).
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+from motionscene_merger.scenemerge import (
+    DEFAULT_SOURCE_RES_DIR,
+    PARSERS,
+    SOURCESETS,
+    InjectionCycleError,
+    SourceFile,
+    SourceGraph,
+    SourceSet,
+    _build_sourcemap,
+    _find_source_sets,
+    _get_output_filename,
+    _parse_sourcesets,
+    log,
+)
+
+DEFAULT_HOTSPOTS = 10  # Number of files listed by --hotspots.
+
+
+class InjectGraph:
+    """
+    Which files inject which in a single SourceSet, keyed by source filename.
+
+    If the sourceset cannot be merged because of a circular or missing <inject/>,
+    error says why and the edges are still recorded: cycle lists the files in the
+    circular path that was found and missing the injected files with no source.
+    The depth and affected outputs of each file are only known when there is no error.
+    """
+    def __init__(self, source_files: List['SourceFile'], keep_transitive=False):
+        graph = SourceGraph(_build_sourcemap(source_files))
+        names = {i: os.path.basename(key) for i, key in enumerate(graph.keys)}
+
+        self.error: Optional[str] = None
+        self.cycle: List[str] = []
+        try:
+            order = graph.order()  # Dependencies first.
+        except (InjectionCycleError, KeyError) as e:
+            self.error = f'{type(e).__name__}: {e}'
+            self.cycle = getattr(e, 'cycle', [])
+            order = [i for i, f in enumerate(graph.files) if f is not None]
+        ordered = [names[i] for i in order]
+        self.missing: List[str] = sorted(names[i] for i, f in enumerate(graph.files) if f is None)
+
+        self.injects: Dict[str, List[str]] = {names[i]: [names[x] for x in graph.injects[i]] for i in order}
+        self.injected_by: Dict[str, List[str]] = {names[i]: [names[x] for x in graph.injected_by[i]] for i in order}
+
+        self.outputs: Dict[str, str] = {  # Source filename -> output filename.
+            names[i]: _get_output_filename(graph.files[i])
+            for i in order
+            if keep_transitive or not graph.injected_by[i]
+        }
+
+        self.depth: Dict[str, int] = {}
+        self.affected: Dict[str, List[str]] = {}
+        if self.error:
+            return
+
+        # Longest chain of injections below each file.
+        for name in ordered:
+            self.depth[name] = max((self.depth[dep] + 1 for dep in self.injects[name]), default=0)
+
+        # Outputs that include each file, directly or transitively.
+        for name in reversed(ordered):
+            affected = {name} if name in self.outputs else set()
+            for parent in self.injected_by[name]:
+                affected.update(self.affected[parent])
+            self.affected[name] = sorted(affected)
+
+    def rdeps(self, filename: str) -> List[str]:
+        """Return the output filenames which would be rebuilt if the given source file changed."""
+        return [self.outputs[name] for name in self.affected[filename]]
+
+    def hotspots(self, n: int = DEFAULT_HOTSPOTS) -> List[str]:
+        """Return the names of up to n injected files which affect the most outputs."""
+        shared = [name for name in self.injects if self.injected_by[name]]
+        return sorted(
+            shared,
+            key=lambda name: (len(self.affected[name]), len(self.injected_by[name]), self.depth[name]),
+            reverse=True,
+        )[:n]
+
+    def to_dict(self) -> dict:
+        return {
+            name: {
+                'injects': self.injects[name],
+                'injected_by': self.injected_by[name],
+                'output': self.outputs.get(name),
+                'fan_in': len(self.injected_by[name]),
+                'depth': self.depth.get(name),
+                'affected_outputs': None if self.error else self.rdeps(name),
+            }
+            for name in sorted(self.injects)
+        }
+
+    def to_dot(self, name: str = 'scenemerge') -> str:
+        lines = [f'digraph {json.dumps(name)} {{', '    rankdir=LR;']
+        for filename in sorted(self.injects):
+            shape = 'box' if filename in self.outputs else 'ellipse'
+            lines.append(f'    {json.dumps(filename)} [shape={shape}];')
+        for filename in self.missing:
+            lines.append(f'    {json.dumps(filename)} [shape=ellipse, style=dashed, color=red];')
+
+        cycle = set(zip(self.cycle, self.cycle[1:]))
+        for filename in sorted(self.injects):
+            for dep in self.injects[filename]:
+                style = ' [color=red]' if (filename, dep) in cycle or dep in self.missing else ''
+                lines.append(f'    {json.dumps(filename)} -> {json.dumps(dep)}{style};')
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+def build_graph(source_set: 'SourceSet', keep_transitive=False, parser: str = PARSERS[0]) -> 'InjectGraph':
+    return InjectGraph([SourceFile(x, parser=parser) for x in source_set.filepaths], keep_transitive)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    source_sets = [
+        source_set
+        for root in args.root
+        for source_set in _find_source_sets(root, args.source, args.resdir, args.exclude)
+    ]
+    graphs = [(source_set, build_graph(source_set, args.keep_transitive, args.parser)) for source_set in source_sets]
+
+    failures = 0
+    for source_set, graph in graphs:
+        if graph.error:
+            failures = failures + 1
+            log.error(f'{source_set}: {graph.error}')
+    # Outputs and hotspots are unknown for sourcesets that cannot be merged.
+    valid = [(source_set, graph) for source_set, graph in graphs if not graph.error]
+
+    if args.rdeps:
+        _print_rdeps(valid, args.rdeps)
+    elif args.hotspots:
+        _print_hotspots(valid, args.hotspots)
+    elif args.format == 'dot':
+        for source_set, graph in graphs:
+            print(graph.to_dot(str(source_set)))
+    else:
+        print(json.dumps([
+            {'sourceset': str(source_set), 'files': graph.to_dict(), 'error': graph.error, 'cycle': graph.cycle}
+            for source_set, graph in graphs
+        ], indent=2))
+
+    if failures:
+        sys.exit(1)
+
+
+def _print_rdeps(graphs, filename: str):
+    filename = os.path.basename(filename)
+    if not filename.endswith('.xml'):
+        filename = f'{filename}.xml'
+
+    found = False
+    for source_set, graph in graphs:
+        if filename in graph.injects:
+            found = True
+            for output_filename in graph.rdeps(filename):
+                print(os.path.join(source_set.output_dir, output_filename))
+
+    if not found:
+        log.error(f'{filename} was not found in any sourceset')
+        sys.exit(1)
+
+
+def _print_hotspots(graphs, n: int):
+    for source_set, graph in graphs:
+        print(f'{source_set}')
+        print(f'    {"outputs":>8}{"fan-in":>8}{"depth":>8}  file')
+        for name in graph.hotspots(n):
+            print(f'    {len(graph.affected[name]):>8}{len(graph.injected_by[name]):>8}{graph.depth[name]:>8}  {name}')
+
+
+def _parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog='scenemerge graph',
+        description='Show the <inject/> dependency graph of each sourceset without merging anything.',
+    )
+
+    parser.add_argument(
+        'root',
+        nargs='+',
+        help=(
+            'Directories to search for Android modules.'
+        )
+    )
+
+    parser.add_argument(
+        '--source',
+        type=_parse_sourcesets,
+        default=['main'],
+        help=(
+            'Which Android sourceset(s) to use, separated by commas e.g. main,debug. '
+            f'Choose from {", ".join(SOURCESETS)}.'
+        )
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        help=(
+            'Glob pattern for directories that should not be searched for source files. Can be repeated.'
+        )
+    )
+
+    parser.add_argument(
+        '--resdir',
+        type=str,
+        default=DEFAULT_SOURCE_RES_DIR,
+        help=(
+            'Name of the directory in which you store your source template files'
+        )
+    )
+
+    parser.add_argument(
+        '-keep_transitive',
+        action='store_true',
+        default=False,
+        help=(
+            'Treat files which are injected into others as outputs too, as with the same option when merging.'
+        )
+    )
+
+    parser.add_argument(
+        '--parser',
+        choices=PARSERS,
+        default=PARSERS[0],
+        help=(
+            'How to find <inject/> tags in source files.'
+        ),
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=['json', 'dot'],
+        default='json',
+        help=(
+            'Format of the graph. `dot` can be rendered with Graphviz.'
+        ),
+    )
+
+    parser.add_argument(
+        '--rdeps',
+        type=str,
+        metavar='FILE',
+        help=(
+            'Instead of the graph, list the outputs that would be rebuilt if the given source file changed.'
+        ),
+    )
+
+    parser.add_argument(
+        '--hotspots',
+        type=int,
+        nargs='?',
+        const=DEFAULT_HOTSPOTS,
+        metavar='N',
+        help=(
+            f'Instead of the graph, list the N (default {DEFAULT_HOTSPOTS}) injected files which affect the most '
+            'outputs, with their fan-in and depth.'
+        ),
+    )
+
+    return parser.parse_args(argv)
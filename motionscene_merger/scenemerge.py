@@ -12,47 +12,90 @@ Requirements:
 
 When you run the script, you should see the merged file `app/src/main/res/xml/your_motionscene_filename.xml`.
 
-Warning: This is a somewhat naive pattern-based find/replace - we do not actually parse the XML tree.
+Warning: By default this is a somewhat naive pattern-based find/replace - we do not actually parse the XML tree.
          We recognise <MotionScene>...<MotionScene/> tags and <inject/> tags - everything else is just
-         treated as plain text, warts and all.
+         treated as plain text, warts and all. Use `--parser xml` to parse source files as XML instead.
 
 """
 
 
-import argparse
-import glob
+import fnmatch
+import hashlib
+import json
 import logging
 import os
 import re
-import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
 from typing import (
+    Callable,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Mapping,
     Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
 )
 
+from motionscene_merger import stats, storage
+from motionscene_merger.stats import RunStats
+from motionscene_merger.storage import DryRunStorage, MemoryStorage
+
+# Handlers are added by main() so that importing this module does not configure logging.
 log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
-log.addHandler(logging.StreamHandler())
 
 
 MERGE_FILE_PREFIX = '_'
 
-TEMP_DIR = 'temp-scenemerge/'
+SOURCESETS = ['main', 'debug', 'test', 'androidTest']
+EXCLUDED_DIRS = {  # Directories which are never searched for source files.
+    'build',
+    'node_modules',
+    '__pycache__',
+}
 DEFAULT_SOURCE_RES_DIR = 'xml'  # Name of the directory in /src/../res/ for storing source files
+CACHE_FILENAME = '.scenemerge-cache.json'  # Stored in the sourceset directory e.g. /src/main/
+QUALIFIER_CACHE_FILENAME = '.scenemerge-cache-{qualifier}.json'  # Cache for the outputs of one --qualifiers entry.
+CACHE_VERSION = 2
+PARSERS = [  # Engines for finding <inject/> tags. The first is the default.
+    'regex',
+    'xml',
+]
+FRAGMENT_CACHE_SIZE = 32 * 1024 * 1024  # Maximum total length of rendered fragments kept in memory.
 
 # <inject arg1="" arg2="" />
-MERGE_TAG_PATTERN = re.compile(rf'^(<!--)?([ ]*)<inject (.*?)/>', flags=re.DOTALL | re.MULTILINE)
+MERGE_TAG_PATTERN = re.compile(
+    r'^(?P<comment><!--)?(?P<indent>[ ]*)<inject (?P<args>.*?)/>',
+    flags=re.DOTALL | re.MULTILINE,
+)
 MERGE_ARGS = [
     'src',
 ]
+MERGE_ARG_PATTERNS = {a: re.compile(f'{a}="(.*?)"') for a in MERGE_ARGS}
+# Any other arguments are parameters, substituted into ${name} placeholders in the injected content.
+MERGE_PARAM_PATTERN = re.compile(r'([\w.:-]+)="(.*?)"')
+TEMPLATE_PARAM_PATTERN = re.compile(r'\$\{(\w+)\}')
 
 UNWRAP_TAGS = [
     'MotionScene',
     'merge',
     'injected',
 ]
-UNWRAP_PATTERN = r'.*?<{tag}.*?>(.*?)</{tag}>.*'
+# Finds <inject/> tags and the opening/closing tags of UNWRAP_TAGS in a single pass.
+SCAN_PATTERN = re.compile(
+    '|'.join([
+        f'(?P<inject>{MERGE_TAG_PATTERN.pattern})',
+        f'<(?P<open>{"|".join(UNWRAP_TAGS)})[^>]*>',
+        f'</(?P<close>{"|".join(UNWRAP_TAGS)})>',
+    ]),
+    flags=re.DOTALL | re.MULTILINE,
+)
 XML_FILE_HEADER = '<?xml version="1.0" encoding="utf-8"?>'
 INJECTION_FILE_HEADER = '<!--\nWARNING: This file was generated by scenemerge - any changes may be overwritten!\nYou should edit the source file \'{filename}\' instead.\n-->\n'
 INJECTION_MESSAGE_START = '<!-- Start injected content from \'{filename}\' -->\n'
@@ -66,216 +109,1367 @@ IGNORED_LINES = [
 ]
 
 
+class InjectionCycleError(Exception):
+    """Raised when a source file directly or transitively injects itself."""
+    def __init__(self, cycle: List[str]):
+        self.cycle = cycle
+        super().__init__(f'Circular <inject/> dependency: {" -> ".join(cycle)}')
+
+
 class SourceFile:
-    def __init__(self, filepath):
+    __slots__ = (
+        'filepath',
+        'parser',
+        'filename',
+        'key',
+        'text',
+        'content_hash',
+        'resolved',
+        'is_injected',
+        'tags',
+        '_scan',
+        '_resolved_hash',
+    )
+
+    def __init__(
+            self,
+            filepath,
+            text: Optional[str] = None,
+            parser: str = PARSERS[0],
+            key: Optional[str] = None,
+    ):
         self.filepath = filepath
+        self.parser = parser  # One of PARSERS, used to find <inject/> tags.
         self.filename = os.path.basename(filepath)
+        # Path relative to the res directory e.g. xml/_scene.xml. Overrides for a
+        # resource qualifier take the key of the file they replace.
+        self.key = key or _get_source_key(filepath)
+        if text is None:
+            text = _read_file(filepath)
+        self.text = text  # Content of the file - updated in place as inject tags are resolved.
+        self.content_hash = _hash(text)  # Hash of the original content, before any injections.
         self.resolved = False  # Set True when all inject tags have been processed.
-        self.dependencies = []
         self.is_injected = False  # Set True when this file has been injected into another.
+        self.tags: Optional[List['MergeTag']] = None  # Populated on first call to get_merge_tags().
+        self._scan: Optional['ScanResult'] = None  # Result of scanning the current text.
+        self._resolved_hash: Optional[str] = None  # Hash of the current text.
 
     def __str__(self):
         return f'{self.filename}: {self.resolved}'
 
+    def copy(self) -> 'SourceFile':
+        """
+        Return a copy of this file which can be resolved separately, sharing its
+        original text and tags so that it is not scanned again. Must be called
+        before this file is resolved.
+        """
+        other = SourceFile.__new__(SourceFile)
+        for name in SourceFile.__slots__:
+            setattr(other, name, getattr(self, name))
+        return other
+
+    def get_merge_tags(self) -> List['MergeTag']:
+        """Read the <inject/> tags from this file. The file is only scanned once."""
+        if self.tags is None:
+            self.tags = self._get_scan().tags
+        return self.tags
+
+    def get_wrapped_content(self) -> Optional[str]:
+        """
+        Return the content within the outer UNWRAP_TAGS element of the resolved text,
+        or None if there is no such element. The resolved text is only scanned once,
+        however many files inject this one.
+        """
+        wrapped = self._get_scan().wrapped
+        if wrapped:
+            return self.text[wrapped[0]:wrapped[1]]
+
+    def get_fragment(self, indent: int, params: Optional[Mapping[str, str]] = None) -> str:
+        """
+        Return the content that should replace an <inject/> tag for this file at the given indent,
+        with any ${name} placeholders replaced by the given params.
+
+        Fragments are compiled into a Template and kept in a shared FragmentCache,
+        so that a file injected into many parents is only rendered once for each
+        indent it appears at, however many different params it is used with.
+        """
+        wrapped = self._get_scan().wrapped
+        if self._resolved_hash is None:
+            self._resolved_hash = _hash(self.text)
+
+        # Wrapped content is copied as-is so does not depend on indent. Parsers
+        # may find different wrapped content in the same text, e.g. nested <merge>.
+        key = (self.filepath, self.parser, self._resolved_hash, None if wrapped else indent)
+        template = _fragment_cache.get(key)
+        if template is None:
+            content = self.text[wrapped[0]:wrapped[1]] if wrapped else _get_generic_content(self.text, indent)
+            template = Template(self._wrap_tag_content(content, self))
+            _fragment_cache.put(key, template)
+        return template.render(params)
+
+    def _get_scan(self) -> 'ScanResult':
+        if self._scan is None:
+            if self.parser == 'xml':
+                from motionscene_merger import xmlparser
+                try:
+                    self._scan = xmlparser.scan(self.text)
+                except xmlparser.XmlScanError as e:
+                    raise xmlparser.XmlScanError(f'{self.filename}: {e}') from None
+            else:
+                self._scan = _scan(self.text)
+        return self._scan
+
+    def get_injected_keys(self) -> List[str]:
+        """Return the key of the source file referenced by each <inject/> tag, in order."""
+        return [_get_tag_key(self, t) for t in self.get_merge_tags()]
+
+    def get_injected_sources(self, sources: Dict[str, 'SourceFile']) -> List['SourceFile']:
+        return [_get_tag_source(self, t, sources) for t in self.get_merge_tags()]
+
     def resolve_injections(self, sources: Dict[str, 'SourceFile']) -> int:
+        """
+        Replace each <inject/> tag with the content of its source file.
+
+        All injected sources must already be resolved, otherwise nothing is
+        changed and this file remains unresolved. Use SourceGraph.order() to
+        find an order in which every file can be resolved in a single call.
+        """
         if self.resolved:
             return 0
 
+        tags = self.get_merge_tags()
+        injected_sources = self.get_injected_sources(sources)
+        if not all(src.resolved for src in injected_sources):
+            # Wait until all sources are resolved.
+            return 0
+
         changes = 0
+        parts = []
+        position = 0  # End of the previous tag in the original text.
+        wrapped = self._get_scan().wrapped
+        resolved_wrapped = wrapped
+
+        for t, src in zip(tags, injected_sources):
+            src.is_injected = True
+
+            content = src.get_fragment(t.indent, t.params)
+            stats.current().count('tags_expanded')
+            parts.append(self.text[position:t.start])
+            parts.append(content)
+            position = t.end
+
+            if wrapped:
+                # Keep track of where the wrapped content ends up in the resolved text
+                # so that it does not need to be scanned again.
+                delta = len(content) - (t.end - t.start)
+                start, end = resolved_wrapped
+                resolved_wrapped = (
+                    start + delta if t.end <= wrapped[0] else start,
+                    end + delta if t.end <= wrapped[1] else end,
+                )
+            changes = changes + 1
 
-        with open(self.filepath, 'r') as f:
-            text = f.read()
+        if parts:
+            parts.append(self.text[position:])
+            self.text = ''.join(parts)
+            self._scan = ScanResult([], resolved_wrapped)
+            self._resolved_hash = None
 
-        tags = _find_merge_tags(text)
+        # No <inject/> tags remaining - text is final
+        self.resolved = True
+        changes = changes + 1
+        return changes
 
-        if len(tags) == 0:
-            # No <inject/> tags found - text is final
-            self.resolved = True
-            changes = changes + 1
-            return changes
+    def _wrap_tag_content(self, text: str, src: 'SourceFile') -> str:
+        before = INJECTION_MESSAGE_START.format(filename=src.filename)
+        after = INJECTION_MESSAGE_END.format(filename=src.filename)
+        return f'{before}{text}{after}'
 
-        for t in tags:
-            if t.src in sources:
-                src = sources[t.src]
-            else:
-                raise KeyError(f'Cannot find source for tag referencing \'{t.src}\': {sources.keys()}')
 
-            if src.resolved:
-                # If source file is resolved, copy its content here.
-                # Otherwise we wait for the next pass to check again
-                self._add_depencency(src)
+class Template:
+    """
+    Text split into literal segments and ${name} placeholders, so that it can
+    be rendered with different params by a single join.
 
-                with open(src.filepath, 'r') as f:
-                    content = _get_wrapped_content(f)
-                    if content is None:
-                        content = _get_generic_content(f, t.indent)
+    Placeholders without a value in params are left as they are, so that they
+    can be filled in by the params of an enclosing <inject/> tag.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.segments = TEMPLATE_PARAM_PATTERN.split(text)  # Literal text at even indices, param names at odd.
 
-                content = self._wrap_tag_content(content, src)
-                text = text.replace(t.tag, content)
-                with open(self.filepath, 'w') as f:
-                    f.write(text)
+    def __len__(self):
+        return len(self.text)
 
-                changes = changes + 1
+    def render(self, params: Optional[Mapping[str, str]] = None) -> str:
+        if not params or len(self.segments) == 1:
+            return self.text
 
-        return changes
+        return ''.join(
+            params.get(segment, f'${{{segment}}}') if i % 2 else segment
+            for i, segment in enumerate(self.segments)
+        )
 
-    def _add_depencency(self, dep: 'SourceFile'):
-        dep.is_injected = True
-        self.dependencies.append(dep.filename)
-        self.dependencies += dep.dependencies
 
-    def _wrap_tag_content(self, text: str, src: 'SourceFile') -> str:
-        before = INJECTION_MESSAGE_START.format(filename=src.filename)
-        after = INJECTION_MESSAGE_END.format(filename=src.filename)
-        return f'{before}{text}{after}'
+class FragmentCache:
+    """
+    Least-recently-used cache of compiled injection fragments, keyed by
+    (source path, parser, hash of resolved source content, indent).
+
+    The total length of cached fragments is kept below max_size by evicting the
+    least recently used fragments first. The cache is shared by every thread.
+    """
+    def __init__(self, max_size: int = FRAGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._fragments: 'OrderedDict[tuple, Template]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, key: tuple) -> Optional['Template']:
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+
+        stats.current().count('fragment_cache_hits' if fragment is not None else 'fragment_cache_misses')
+        return fragment
+
+    def put(self, key: tuple, fragment: 'Template'):
+        if len(fragment) > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._fragments.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._fragments[key] = fragment
+            self.size += len(fragment)
+            while self.size > self.max_size:
+                _, evicted = self._fragments.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.size = 0
+
+
+_fragment_cache = FragmentCache()
+
+
+class MergeResult:
+    """Output filenames grouped by what happened to them during a merge."""
+    def __init__(self):
+        self.written = []  # Created or updated.
+        self.unchanged = []  # Already up to date on disk.
+        self.removed = []  # Previously generated by scenemerge but no longer have a source.
+        self.changes: Dict[str, str] = {}  # Output filename -> summary of the change. Only set by _check_source_set().
+        self.records: Dict[str, dict] = {}  # Output filename -> report record. Only set if requested, see _merge_sources().
+
+    def __str__(self):
+        return f'{len(self.written)} written, {len(self.unchanged)} unchanged, {len(self.removed)} removed'
+
+    def extend(self, other: 'MergeResult', prefix: str = ''):
+        """Add the outputs of other to this result, with prefix added to each of their filenames."""
+        self.written += [f'{prefix}{x}' for x in other.written]
+        self.unchanged += [f'{prefix}{x}' for x in other.unchanged]
+        self.removed += [f'{prefix}{x}' for x in other.removed]
+        self.changes.update({f'{prefix}{k}': v for k, v in other.changes.items()})
+        self.records.update({f'{prefix}{k}': v for k, v in other.records.items()})
+
+
+class SourceSet:
+    """
+    The source files found in the res directory of one sourceset of one module,
+    e.g. app/src/main/res/xml/_*.xml. Each SourceSet is merged independently.
+
+    Outputs for a resource qualifier e.g. land are written to res/xml-land,
+    using any source files in res/{res_dir}-land in place of those with the
+    same name in res/{res_dir}.
+    """
+    def __init__(self, res_path: str, filepaths: List[str], res_dir: str = DEFAULT_SOURCE_RES_DIR):
+        self.res_path = res_path  # e.g. app/src/main/res
+        self.filepaths = filepaths
+        self.res_dir = res_dir  # Name of the directory in res_path containing filepaths.
+
+    def __str__(self):
+        return os.path.dirname(os.path.normpath(self.res_path))
+
+    @property
+    def name(self) -> str:
+        """Name of the Android sourceset e.g. main, debug."""
+        return os.path.basename(str(self))
+
+    @property
+    def source_dir(self) -> str:
+        return os.path.join(self.res_path, self.res_dir)
+
+    @property
+    def output_dir(self) -> str:
+        return self.get_output_dir()
+
+    @property
+    def cache_path(self) -> str:
+        return self.get_cache_path()
+
+    def get_output_dir(self, qualifier: Optional[str] = None) -> str:
+        return os.path.join(self.res_path, f'xml-{qualifier}' if qualifier else 'xml')
+
+    def get_cache_path(self, qualifier: Optional[str] = None) -> str:
+        filename = QUALIFIER_CACHE_FILENAME.format(qualifier=qualifier) if qualifier else CACHE_FILENAME
+        return os.path.join(str(self), filename)
+
+    def get_override_filepaths(self, qualifier: str) -> List[str]:
+        """Return the paths of the source files which replace or add to filepaths for the given qualifier."""
+        return _list_source_files(os.path.join(self.res_path, f'{self.res_dir}-{qualifier}'))
+
+    def get_output_path(self, output_filename: str) -> str:
+        """
+        Return the path of an output as named in a MergeResult, e.g. scene.xml, or
+        xml-land/scene.xml for an output of the land qualifier.
+        """
+        directory, _, filename = output_filename.rpartition('/')
+        if directory:
+            return os.path.join(self.res_path, directory, filename)
+        return os.path.join(self.output_dir, filename)
+
+
+class BuildCache:
+    """
+    Persistent record of the inputs and content of each generated output file.
+
+    This is also the manifest of which files in the output directory belong to
+    scenemerge: only outputs recorded here are ever removed.
+
+    An output is up to date if its source and every file in its dependency closure
+    have the same content hash as when it was last written, and the output file
+    itself has not been changed or removed since. The closure is recorded as a
+    single digest (see _get_inputs_digest()) to keep the manifest small.
+    """
+    def __init__(self, path: str, outputs: Optional[Dict[str, dict]] = None):
+        self.path = path
+        self.outputs = outputs or {}  # Output filename -> {'source', 'inputs' digest, 'hash'}
+
+    @classmethod
+    def load(cls, path: str) -> 'BuildCache':
+        try:
+            data = json.loads(_read_file(path))
+        except (OSError, ValueError):
+            return cls(path)
+
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            log.info(f'Ignoring incompatible cache {path}')
+            return cls(path)
+
+        return cls(path, data.get('outputs'))
+
+    def save(self):
+        # Left untouched when nothing changed, so that a no-op run writes nothing at all.
+        _write_if_changed(self.path, json.dumps({'version': CACHE_VERSION, 'outputs': self.outputs}, indent=2, sort_keys=True))
+
+    def is_up_to_date(self, output_path: str, inputs: str) -> bool:
+        entry = self.outputs.get(os.path.basename(output_path))
+        if entry is None or entry.get('inputs') != inputs:
+            return False
+
+        try:
+            return _hash(_read_file(output_path)) == entry.get('hash')
+        except OSError:
+            return False
+
+    def update(self, output_path: str, src: 'SourceFile', inputs: str, output_hash: str):
+        self.outputs[os.path.basename(output_path)] = {
+            'source': src.filename,
+            'inputs': inputs,
+            'hash': output_hash,
+        }
+
+    def retain(self, output_filenames: Set[str]) -> Dict[str, dict]:
+        """Forget any outputs that are no longer generated, returning the entries that were removed."""
+        removed = {k: v for k, v in self.outputs.items() if k not in output_filenames}
+        self.outputs = {k: v for k, v in self.outputs.items() if k in output_filenames}
+        return removed
 
 
 class MergeTag:
-    def __init__(self, tag: str,  src: str, indent: int):
+    __slots__ = ('tag', 'src', 'indent', 'params', 'start', 'end')
+
+    def __init__(
+            self,
+            tag: str,
+            src: str,
+            indent: int,
+            start: int = 0,
+            end: int = 0,
+            params: Optional[Dict[str, str]] = None,
+    ):
         if not src.endswith('.xml'):
             src = f'{src}.xml'
         self.tag = tag  # Original text of the <inject .../> tag this represents
         self.src = src
         self.indent = indent
+        self.params = params or {}  # Values for ${name} placeholders in the injected content.
+        self.start = start  # Position of the tag in the text it was found in.
+        self.end = end
 
     def __str__(self):
         return f'{self.tag}'
 
 
+class ScanResult:
+    __slots__ = ('tags', 'wrapped')
+
+    def __init__(self, tags: List['MergeTag'], wrapped: Optional[Tuple[int, int]]):
+        self.tags = tags
+        self.wrapped = wrapped  # (start, end) of the content within the outer UNWRAP_TAGS element, if any.
+
+
 def _parse_mergetag(match) -> Optional['MergeTag']:
-    if match.group(1):
+    if match.group('comment'):
         """Comment tag `<!--` found at start of line - tag should be ignored."""
         return
-    indent = len(match.group(2))
-    args_src = match.group(3)
+    indent = len(match.group('indent'))
+    args_src = match.group('args')
 
     args = {}
-    for a in MERGE_ARGS:
-        args[a] = re.search(f'{a}="(.*?)"', args_src)[1]
+    for a, pattern in MERGE_ARG_PATTERNS.items():
+        args[a] = pattern.search(args_src)[1]
+    params = {name: value for name, value in MERGE_PARAM_PATTERN.findall(args_src) if name not in MERGE_ARGS}
 
-    return MergeTag(tag=match.group(0), indent=indent, **args)
+    return MergeTag(tag=match.group(0), indent=indent, start=match.start(), end=match.end(), params=params, **args)
+
+
+def _scan(text: str) -> 'ScanResult':
+    """
+    Find all <inject/> tags and the wrapped content region of text in a single pass.
+
+    The wrapped region is the content between the first opening tag of one of
+    UNWRAP_TAGS and the first matching closing tag after it. If several of
+    UNWRAP_TAGS are present, the one listed first in UNWRAP_TAGS is used.
+    """
+    tags = []
+    opened = {}  # Tag name -> end of its first opening tag
+    closed = {}  # Tag name -> start of the first closing tag after it was opened
+
+    for match in SCAN_PATTERN.finditer(text):
+        if match.group('inject'):
+            tag = _parse_mergetag(match)
+            if tag:
+                tags.append(tag)
+            continue
+
+        name = match.group('open')
+        if name:
+            opened.setdefault(name, match.end())
+            continue
+
+        name = match.group('close')
+        if name in opened and name not in closed:
+            closed[name] = match.start()
+
+    wrapped = None
+    for name in UNWRAP_TAGS:
+        if name in closed:
+            wrapped = (opened[name], closed[name])
+            break
+
+    return ScanResult(tags, wrapped)
 
 
 def _find_merge_tags(src_text: str) -> List[MergeTag]:
-    matches = [x for x in MERGE_TAG_PATTERN.finditer(src_text)]
-    return list(filter(None, [_parse_mergetag(m) for m in matches]))
+    return _scan(src_text).tags
+
+
+def _get_source_key(filepath: str) -> str:
+    """Return the path of a source file relative to its res directory, e.g. xml/_scene.xml."""
+    directory = os.path.basename(os.path.dirname(filepath))
+    filename = os.path.basename(filepath)
+    return f'{directory}/{filename}' if directory else filename
+
+
+def _get_tag_key(src: 'SourceFile', tag: MergeTag) -> str:
+    """Return the key of the file injected by tag, which is in the same directory as src."""
+    directory = src.key.rpartition('/')[0]
+    return f'{directory}/{tag.src}' if directory else tag.src
+
+
+def _get_tag_source(src: 'SourceFile', tag: MergeTag, sources: Dict[str, 'SourceFile']) -> 'SourceFile':
+    key = _get_tag_key(src, tag)
+    if key in sources:
+        return sources[key]
+    raise KeyError(f'Cannot find source for tag referencing \'{tag.src}\' in {src.key}: {list(sources)}')
+
+
+_VISITING = 1
+_VISITED = 2
+
+
+class SourceGraph:
+    """
+    The <inject/> graph of a set of source files, keyed by SourceFile.key.
+
+    Every key is interned as an integer id and each edge is stored once, however
+    many times one file injects another, so memory is linear in the number of
+    files and distinct edges. Keys which are injected but have no source file
+    still get an id, with None in place of the file, so that the graph can be
+    built for an incomplete set of files. order() raises KeyError for them.
+
+    Transitive closures are not stored. closure() and dependents() walk the
+    graph when they are needed, visiting each file at most once per call.
+    """
+    __slots__ = ('keys', 'ids', 'files', 'injects', 'injected_by')
+
+    def __init__(self, sources: Mapping[str, 'SourceFile']):
+        self.keys: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.files: List[Optional['SourceFile']] = []
+        self.injects: List[Tuple[int, ...]] = []  # Direct dependencies of each file, in the order they are injected.
+        self.injected_by: List[List[int]] = []  # Files which directly inject each file.
+
+        for key, f in sources.items():
+            self.files[self._intern(key)] = f
+
+        for i, f in enumerate(sources.values()):
+            deps = tuple(dict.fromkeys(self._intern(key) for key in f.get_injected_keys()))
+            self.injects[i] = deps
+            for dep in deps:
+                self.injected_by[dep].append(i)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _intern(self, key: str) -> int:
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.files.append(None)
+            self.injects.append(())
+            self.injected_by.append([])
+        return i
+
+    def get_ids(self, keys: Iterable[str]) -> Set[int]:
+        """Return the ids of any of keys which are in the graph."""
+        return {self.ids[key] for key in keys if key in self.ids}
+
+    def order(self) -> List[int]:
+        """
+        Return the ids of all source files ordered so that each appears after every file it injects.
+
+        The graph is walked depth-first with an explicit stack, so there is no
+        limit on nesting depth. Raises InjectionCycleError with the offending
+        path if a file (directly or transitively) injects itself.
+        """
+        order = []
+        state = bytearray(len(self.keys))
+
+        for root, f in enumerate(self.files):
+            if f is None or state[root]:
+                continue
+
+            state[root] = _VISITING
+            path = [root]
+            pending = [iter(self.injects[root])]
+
+            while pending:
+                dep = next(pending[-1], None)
+                if dep is None:
+                    # All dependencies of the file at the top of the stack are done.
+                    pending.pop()
+                    done = path.pop()
+                    state[done] = _VISITED
+                    order.append(done)
+                    continue
+
+                if state[dep] == _VISITED:
+                    continue
+                if state[dep] == _VISITING:
+                    cycle = path[path.index(dep):] + [dep]
+                    raise InjectionCycleError([self.files[x].filename for x in cycle])
+                if self.files[dep] is None:
+                    raise KeyError(
+                        f'Cannot find source for tag referencing \'{self.keys[dep]}\' in {self.keys[path[-1]]}: '
+                        f'{[key for key, f in zip(self.keys, self.files) if f is not None]}'
+                    )
+
+                state[dep] = _VISITING
+                path.append(dep)
+                pending.append(iter(self.injects[dep]))
+
+        return order
+
+    def closure(self, ids: Iterable[int]) -> Set[int]:
+        """Return the given ids and the ids of every file they inject, directly or transitively."""
+        return _walk(ids, self.injects)
+
+    def dependents(self, ids: Iterable[int]) -> Set[int]:
+        """Return the given ids and the ids of every file which injects them, directly or transitively."""
+        return _walk(ids, self.injected_by)
+
+
+def _walk(ids: Iterable[int], edges: List[Iterable[int]]) -> Set[int]:
+    found = set(ids)
+    pending = list(found)
+    while pending:
+        for x in edges[pending.pop()]:
+            if x not in found:
+                found.add(x)
+                pending.append(x)
+    return found
 
 
 def _get_source_filepaths(rootdir: str, sourceset: str, res_dir: str) -> List[str]:
-    glb = f'{rootdir}/**/{sourceset}/res/{res_dir}/{MERGE_FILE_PREFIX}*.xml'.replace('//', '/')
-    print(glb)
-    result = glob.glob(glb, recursive=True)
-    log.info(f'Found {len(result)} files in xml resource directory (root={rootdir})...')
-    return result
+    return [path for source_set in _find_source_sets(rootdir, [sourceset], res_dir) for path in source_set.filepaths]
+
+
+def _find_source_sets(
+        root: str,
+        sourcesets: List[str],
+        res_dir: str,
+        exclude: Optional[List[str]] = None,
+) -> List['SourceSet']:
+    """
+    Find every {sourceset}/res/{res_dir}/_*.xml under root for each of the given sourcesets,
+    grouped by the module res directory they belong to.
+
+    The tree is walked once. Hidden directories (e.g. .git, .gradle), EXCLUDED_DIRS,
+    the contents of res directories and anything matching one of the
+    `exclude` glob patterns (matched against the directory name or its path
+    relative to root) are not searched.
+    """
+    exclude = exclude or []
+    source_sets = []
+    pending = [root]
+
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or _is_excluded_dir(entry, root, exclude):
+                continue
+
+            if entry.name in sourcesets:
+                source_set = _get_source_set(os.path.join(entry.path, 'res'), res_dir)
+                if source_set:
+                    source_sets.append(source_set)
+
+            if entry.name != 'res':
+                pending.append(entry.path)
+
+    source_sets.sort(key=lambda x: x.res_path)
+    if log.isEnabledFor(logging.INFO):
+        log.info(f'Found {sum(len(x.filepaths) for x in source_sets)} source files in {len(source_sets)} sourcesets (root={root})...')
+    return source_sets
+
+
+def _is_excluded_dir(entry: os.DirEntry, root: str, exclude: List[str]) -> bool:
+    if entry.name.startswith('.') or entry.name in EXCLUDED_DIRS:
+        return True
+    if exclude:
+        relpath = os.path.relpath(entry.path, root)
+        return any(fnmatch.fnmatch(entry.name, x) or fnmatch.fnmatch(relpath, x) for x in exclude)
+    return False
+
+
+def _get_source_set(res_path: str, res_dir: str) -> Optional['SourceSet']:
+    filepaths = _list_source_files(os.path.join(res_path, res_dir))
+    # A sourceset whose last source file was removed is still merged while it has a
+    # manifest, so that the outputs generated from those files are removed too.
+    if filepaths or _has_cache(os.path.dirname(os.path.normpath(res_path))):
+        return SourceSet(res_path, filepaths, res_dir)
+
+
+def _has_cache(directory: str) -> bool:
+    """Return True if directory contains the manifest of the outputs of any sourceset or qualifier."""
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return False
+
+    qualifier_pattern = QUALIFIER_CACHE_FILENAME.format(qualifier='*')
+    return any(x == CACHE_FILENAME or fnmatch.fnmatch(x, qualifier_pattern) for x in filenames)
+
+
+def _list_source_files(directory: str) -> List[str]:
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return []
+
+    return sorted(
+        entry.path for entry in entries
+        if entry.name.startswith(MERGE_FILE_PREFIX) and entry.name.endswith('.xml') and entry.is_file()
+    )
+
+
+def merge(sources: Mapping[str, str], keep_transitive=False, parser: str = PARSERS[0]) -> Dict[str, str]:
+    """
+    Merge source files held in memory, without reading or writing any files.
+
+    sources: Source filename -> content, e.g. {'_scene.xml': '<MotionScene>...'}
+    Returns output filename -> merged content, e.g. {'scene.xml': '...'}
+
+    Raises InjectionCycleError or KeyError for invalid <inject/> tags, as a merge on disk would.
+    """
+    source_files = [SourceFile(filename, text, parser) for filename, text in sources.items()]
+    with storage.use(MemoryStorage()) as memory:
+        _merge_sources(source_files, '', keep_transitive)
+    return memory.files
 
 
 def _merge_sources_for_directory(
         root: str,
         sourceset: str = 'main',
         res_dir: str = DEFAULT_SOURCE_RES_DIR,
-        keep_transitive=False
-):
-    source_filepaths = _get_source_filepaths(root, sourceset, res_dir)
-    working_filepaths = _clone_to_working_directory(source_filepaths)
-    working_files = [SourceFile(x) for x in working_filepaths]
+        keep_transitive=False,
+        incremental=False,
+        force=False,
+) -> 'MergeResult':
+    """Merge every module sourceset found under root, one after another."""
+    result = MergeResult()
+    with stats.current().phase('discovery'):
+        source_sets = _find_source_sets(root, [sourceset], res_dir)
+    for source_set in source_sets:
+        result.extend(_merge_source_set(source_set, keep_transitive, incremental, force))
+    return result
 
-    sourceset_res_dir = glob.glob(f'{root}/**/{sourceset}/res/', recursive=True)[0]
-    output_dir = os.path.join(sourceset_res_dir, 'xml')
-    _merge_sources(working_files, output_dir, keep_transitive)
 
-    _clean_up()
+def _merge_source_set(
+        source_set: 'SourceSet',
+        keep_transitive=False,
+        incremental=False,
+        force=False,
+        stream=False,
+        parser: str = PARSERS[0],
+        qualifiers: Sequence[str] = (),
+        report=False,
+) -> 'MergeResult':
+    """
+    incremental: Skip outputs that are unchanged since the previous run.
+    force: Rebuild every output, even with incremental.
+    stream: Write outputs in chunks as they are expanded - see _merge_sources().
+    parser: One of PARSERS, used to find <inject/> tags in source files.
+    qualifiers: Resource qualifiers e.g. ['land', 'v31'] to also write outputs for,
+                in xml-land/ etc. Outputs for each qualifier are named e.g.
+                xml-land/scene.xml in the result.
+    report: Describe each output in result.records - see _merge_sources().
+    """
+    # Another run merging into the same directory could otherwise interleave
+    # its writes with ours, or save a cache that does not match the outputs.
+    # Qualifier outputs are only written by runs which hold this lock too.
+    with storage.current().lock(source_set.output_dir):
+        with stats.current().phase('load'):
+            source_files = [SourceFile(x, parser=parser) for x in source_set.filepaths]
+            overrides = {qualifier: _load_overrides(source_set, qualifier, parser) for qualifier in qualifiers}
+            # Copies must be taken before the shared files are resolved.
+            qualified_files = {qualifier: _apply_overrides(source_files, overrides[qualifier]) for qualifier in qualifiers}
+
+        result = MergeResult()
+        for qualifier, files in [(None, source_files), *qualified_files.items()]:
+            with stats.current().phase('cache'):
+                cache = BuildCache.load(source_set.get_cache_path(qualifier))
+
+            output_dir = source_set.get_output_dir(qualifier)
+            result.extend(
+                _merge_sources(
+                    files,
+                    output_dir,
+                    keep_transitive,
+                    cache,
+                    stream=stream,
+                    incremental=incremental and not force,
+                    report=report,
+                ),
+                prefix=f'{os.path.basename(output_dir)}/' if qualifier else '',
+            )
+        return result
+
+
+def _load_overrides(source_set: 'SourceSet', qualifier: str, parser: str = PARSERS[0]) -> List['SourceFile']:
+    """Load the source files for the given qualifier, with the keys of the files in source_set they replace."""
+    overrides = []
+    for path in source_set.get_override_filepaths(qualifier):
+        key = _get_source_key(os.path.join(source_set.source_dir, os.path.basename(path)))
+        overrides.append(SourceFile(path, parser=parser, key=key))
+    return overrides
+
+
+def _apply_overrides(source_files: List['SourceFile'], overrides: List['SourceFile']) -> List['SourceFile']:
+    """
+    Return source_files with each file replaced by the override with the same key, if any,
+    followed by any overrides which do not replace a file.
 
+    Files which inject an override, directly or transitively, are replaced by
+    unresolved copies so that they are resolved again with the override. Every
+    other file is returned as it is, so it is only resolved once however many
+    qualifiers it is used for.
+    """
+    graph = SourceGraph(_build_sourcemap(source_files))
+    replacements = {f.key: f for f in overrides}
+    affected = graph.dependents(graph.get_ids(replacements))
+
+    files = []
+    for f in source_files:
+        if f.key in replacements:
+            files.append(replacements.pop(f.key))
+        elif graph.ids[f.key] in affected:
+            files.append(f.copy())
+        else:
+            files.append(f)
+    return files + list(replacements.values())
+
+
+def _check_source_set(source_set: 'SourceSet', **kwargs) -> 'MergeResult':
+    """
+    Merge source_set without changing any files, to find which outputs are out of date.
 
-def _merge_sources(source_files: List['SourceFile'], output_dir: str, keep_transitive=False):
-    """Resolve inject tags until all have been handled."""
-    sources = _build_sourcemap(source_files)
+    The written and removed outputs of the result are those that a real merge
+    would change, and result.changes describes each of them.
+    """
+    dry_run = DryRunStorage(storage.current())
+    with storage.use(dry_run):
+        result = _merge_source_set(source_set, **kwargs)
+
+    for output_filename in result.written:
+        path = source_set.get_output_path(output_filename)
+        result.changes[output_filename] = _describe_change(path, dry_run.written[path])
+    for output_filename in result.removed:
+        result.changes[output_filename] = 'no longer generated'
+    return result
 
-    loop_count = 0
-    while True:
-        changes = 0
-        for f in source_files:
-            changes = changes + f.resolve_injections(sources)
 
-        if changes == 0:
-            break
+def _describe_change(path: str, content: str) -> str:
+    """Summarise the difference between the file at path and the given content, e.g. '+3 -1 lines'."""
+    try:
+        current = _read_file(path)
+    except OSError:
+        return 'missing'
+
+    import difflib
+
+    added = removed = 0
+    for line in difflib.unified_diff(current.splitlines(), content.splitlines(), n=0, lineterm=''):
+        if line.startswith('+') and not line.startswith('+++'):
+            added = added + 1
+        elif line.startswith('-') and not line.startswith('---'):
+            removed = removed + 1
+    return f'+{added} -{removed} lines'
 
-        loop_count = loop_count + 1
-        if loop_count > 10:
-            raise Exception("Excessive looping")
 
-    unresolved = [x for x in source_files if not x.resolved]
-    if unresolved:
-        log.warning(f'Process finished with {len(unresolved)} unresolved <inject/> tags:')
-        for x in unresolved:
-            log.warning(f'{x.filename} with dependencies={x.dependencies}')
-        log.warning(f'Available sources: {sources.keys()}')
+def _merge_source_set_safely(
+        source_set: 'SourceSet',
+        check=False,
+        **kwargs,
+) -> Tuple[Optional['MergeResult'], Optional[str], 'RunStats']:
+    """
+    Returns the result of the merge or a description of the error that stopped it, and stats for the merge.
+    If check is True, nothing is written - see _check_source_set().
+    """
+    merge_source_set = _check_source_set if check else _merge_source_set
+    with stats.collect() as run_stats:
+        try:
+            return merge_source_set(source_set, **kwargs), None, run_stats
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}', run_stats
+
+
+def _merge_source_sets(
+        source_sets: List['SourceSet'],
+        jobs: Optional[int] = None,
+        **kwargs,
+) -> List[Tuple['SourceSet', Optional['MergeResult'], Optional[str]]]:
+    """
+    Merge each of source_sets independently, using up to `jobs` worker processes.
+    An error in one SourceSet does not prevent the others from being merged.
+
+    Returns (source_set, result, error) for each SourceSet. Stats from every
+    merge are added to the current RunStats.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(source_sets))
+
+    if jobs <= 1:
+        # Not worth the cost of starting a process pool.
+        results = [_merge_source_set_safely(s, **kwargs) for s in source_sets]
     else:
-        log.debug(f'Finished in {loop_count} passes')
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_merge_source_set_safely, s, **kwargs) for s in source_sets]
+            results = [f.result() for f in futures]
+
+    for _, _, run_stats in results:
+        stats.current().merge(run_stats)
+
+    return [(source_set, result, error) for source_set, (result, error, _) in zip(source_sets, results)]
+
+
+def _merge_sources(
+        source_files: List['SourceFile'],
+        output_dir: str,
+        keep_transitive=False,
+        cache: Optional['BuildCache'] = None,
+        changed: Optional[Set[str]] = None,
+        stream=False,
+        incremental=False,
+        report=False,
+) -> 'MergeResult':
+    """
+    Resolve inject tags in dependency order so that each file is expanded exactly once.
+
+    Output files are only written if their content has changed.
+
+    If changed is given, only outputs which are generated from or depend on one
+    of those source files, given by SourceFile.key, are rebuilt.
+
+    If a cache is given, it is updated with every output that is written.
+    Outputs recorded in the cache which are no longer generated, because their
+    source was removed or is now only injected into other files, are removed.
+    If incremental is also True, only outputs whose dependency closure has
+    changed since they were last written are rebuilt.
+
+    If stream is True, files are not resolved in memory. Instead, each output is
+    expanded directly from the original source text and written in chunks, so
+    no fully expanded document is ever held in memory.
+
+    If report is True, result.records describes each output: its path, the path
+    of its source and of every file it includes (dependencies first), its size in bytes,
+    the seconds spent resolving and writing it, and its status - one of
+    'written', 'skipped' (already up to date) or 'removed'.
+    """
+    result = MergeResult()
+    run_stats = stats.current()
+    run_stats.count('passes')
+
+    with run_stats.phase('graph'):
+        sources = _build_sourcemap(source_files)
+        graph = SourceGraph(sources)
+        order = graph.order()
+        ordered_files = [graph.files[i] for i in order]
+        # Position of each file in the order, to list the dependencies of each output in the report.
+        positions = {i: n for n, i in enumerate(order)} if report else {}
 
-    # Merging complete - now copy the resulting files to output directory
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    for f in source_files:
+        f.is_injected = bool(graph.injected_by[graph.ids[f.key]])
 
     if keep_transitive:
-        files_to_be_copied = source_files
+        outputs = source_files
     else:
-        files_to_be_copied = [src for src in source_files if not src.is_injected]
+        outputs = [src for src in source_files if not src.is_injected]
+
+    files_to_be_written = outputs
+    if changed is not None:
+        affected = graph.dependents(graph.get_ids(changed))
+        files_to_be_written = [src for src in files_to_be_written if graph.ids[src.key] in affected]
+
+    inputs = {}
+    if cache is not None:
+        with run_stats.phase('cache'):
+            for src in files_to_be_written:
+                inputs[src.key] = _get_inputs_digest(graph, src)
+            obsolete = cache.retain({_get_output_filename(src) for src in outputs})
+            for output_filename, entry in obsolete.items():
+                output_path = os.path.join(output_dir, output_filename)
+                if _remove_generated_file(output_path, entry.get('hash')):
+                    result.removed.append(output_filename)
+                    if report:
+                        result.records[output_filename] = _get_record(output_path, None, 'removed')
+
+            if incremental:
+                stale = []
+                for src in files_to_be_written:
+                    output_path = os.path.join(output_dir, _get_output_filename(src))
+                    if cache.is_up_to_date(output_path, inputs[src.key]):
+                        result.unchanged.append(_get_output_filename(src))
+                        if report:
+                            result.records[_get_output_filename(src)] = _get_record(
+                                output_path, src.filepath, 'skipped', _get_dependencies(graph, positions, src),
+                            )
+                    else:
+                        stale.append(src)
+                log.info('%d outputs are up to date, rebuilding %d', len(result.unchanged), len(stale))
+                files_to_be_written = stale
+
+    # Only files that contribute to an output need to be resolved.
+    required = graph.closure(graph.ids[src.key] for src in files_to_be_written)
+    ordered_files = [f for f in ordered_files if graph.ids[f.key] in required]
+
+    if stream:
+        ordered_files = []
+
+    resolve_times = {}  # Key -> seconds spent resolving that file.
+    with run_stats.phase('resolve'):
+        for f in ordered_files:
+            start = time.perf_counter()
+            f.resolve_injections(sources)
+            resolve_times[f.key] = time.perf_counter() - start
+            run_stats.time_file(f.filepath, resolve_times[f.key])
+        run_stats.count('files_resolved', len(ordered_files))
+
+    log.debug('Resolved %d files', len(ordered_files))
+
+    # Merging complete - now write the resulting files to output directory
+    with run_stats.phase('write'):
+        storage.current().makedirs(output_dir)
+
+        for src in files_to_be_written:
+            start = time.perf_counter()
+            output_filename = _get_output_filename(src)
+            output_path = os.path.join(output_dir, output_filename)
+            if stream:
+                written, output_hash, size = _write_chunks_if_changed(
+                    output_path,
+                    lambda: _iter_output(src, sources),
+                )
+            else:
+                content = _render_output(src)
+                written, output_hash = _write_if_changed(output_path, content), _hash(content)
+                size = len(content.encode('utf-8')) if report else None
+
+            if written:
+                result.written.append(output_filename)
+            else:
+                result.unchanged.append(output_filename)
+
+            if report:
+                result.records[output_filename] = _get_record(
+                    output_path,
+                    src.filepath,
+                    'written' if written else 'skipped',
+                    _get_dependencies(graph, positions, src),
+                    size,
+                    resolve_times.get(src.key, 0) + time.perf_counter() - start,
+                )
+
+            if cache is not None:
+                cache.update(output_path, src, inputs[src.key], output_hash)
+
+    if cache is not None:
+        with run_stats.phase('cache'):
+            cache.save()
+
+    return result
+
+
+def _get_inputs_digest(graph: 'SourceGraph', src: 'SourceFile') -> str:
+    """
+    Return a hash of the key and content hash of src and every file in its dependency closure,
+    and of the parser, which may find different content to inject in the same files.
+    """
+    closure = sorted((graph.keys[i], graph.files[i].content_hash) for i in graph.closure([graph.ids[src.key]]))
+    return _hash('\n'.join([src.parser, *(f'{key} {content_hash}' for key, content_hash in closure)]))
 
-    for src in files_to_be_copied:
-        with open(src.filepath, 'r') as f:
-            content = f.read()
 
-        output_filename = src.filename.replace(MERGE_FILE_PREFIX, '', 1)
-        content = content.replace(
-            XML_FILE_HEADER,
-            f'{XML_FILE_HEADER}\n{INJECTION_FILE_HEADER.format(filename=src.filename)}')
-        with open(os.path.join(output_dir, output_filename), 'w') as f:
-            f.write(content)
+def _write_if_changed(path: str, content: str) -> bool:
+    """
+    Write content to path unless the file already contains exactly that content.
+    Leaving identical files untouched preserves their mtime so that Gradle does
+    not treat them as modified. Returns True if the file was written.
+    """
+    try:
+        if _read_file(path) == content:
+            return False
+    except OSError:
+        pass
 
+    _write_file(path, content)
+    return True
 
-def _build_sourcemap(source_files: List['SourceFile']) -> Dict['str', 'SourceFile']:
+
+def _write_chunks_if_changed(path: str, render: Callable[[], Iterable[str]]) -> Tuple[bool, str, int]:
+    """
+    Equivalent to _write_if_changed() for content produced in chunks by render().
+
+    The content is rendered once to find its hash, which is compared with the
+    hash of the existing file, and rendered again only if it needs writing.
+    Returns (True if the file was written, hash of the content, size of the content in bytes).
+    """
+    digest = hashlib.sha1()
+    size = 0
+    for chunk in render():
+        data = chunk.encode('utf-8')
+        digest.update(data)
+        size += len(data)
+    content_hash = digest.hexdigest()
+
+    try:
+        if _hash_file(path) == content_hash:
+            return False, content_hash, size
+    except OSError:
+        pass
+
+    storage.current().write_chunks(path, render())
+    return True, content_hash, size
+
+
+def _get_dependencies(graph: 'SourceGraph', positions: Dict[int, int], src: 'SourceFile') -> List[str]:
+    """
+    Return the paths of every file included in the output of src, with dependencies
+    before the files that inject them. positions is the index of each id in graph.order().
+    """
+    closure = graph.closure([graph.ids[src.key]])
+    closure.discard(graph.ids[src.key])
+    return [graph.files[i].filepath for i in sorted(closure, key=positions.__getitem__)]
+
+
+def _get_record(
+        path: str,
+        source: Optional[str],
+        status: str,
+        dependencies: Optional[List[str]] = None,
+        size: Optional[int] = None,
+        seconds: Optional[float] = None,
+) -> dict:
+    """Describe one output for the run report - see _merge_sources()."""
     return {
-        sourcefile.filename: sourcefile for sourcefile in source_files
+        'path': path,
+        'source': source,
+        'dependencies': dependencies or [],
+        'bytes': size,
+        'seconds': seconds,
+        'status': status,
     }
 
 
-def _clone_to_working_directory(xml_files: List[str]) -> List[str]:
-    """Copy files to a temporary directory for processing."""
-    if not os.path.exists(TEMP_DIR):
-        os.makedirs(TEMP_DIR)
+def _remove_generated_file(path: str, expected_hash: Optional[str]) -> bool:
+    """
+    Remove a file that was previously generated by scenemerge, unless it has
+    since been edited by hand. Returns True if the file was removed.
+    """
+    try:
+        if _hash(_read_file(path)) != expected_hash:
+            log.warning(f'Not removing {path}: it has been modified since it was generated')
+            return False
+        storage.current().remove(path)
+    except OSError:
+        return False
+    return True
+
+
+def _read_file(path: str) -> str:
+    return storage.current().read(path)
+
+
+def _write_file(path: str, content: str):
+    storage.current().write(path, content)
+
+
+def _hash_file(path: str) -> str:
+    """Equivalent to _hash(_read_file(path)) without reading the whole file at once."""
+    digest = hashlib.sha1()
+    for chunk in storage.current().read_chunks(path):
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _render_output(src: 'SourceFile') -> str:
+    """Return the final content of the output file for a resolved source."""
+    return src.text.replace(
+        XML_FILE_HEADER,
+        f'{XML_FILE_HEADER}\n{INJECTION_FILE_HEADER.format(filename=src.filename)}')
+
+
+def _iter_output(src: 'SourceFile', sources: Dict[str, 'SourceFile']) -> Iterator[str]:
+    """
+    Yield the content of the output file for src in chunks, equivalent to
+    _render_output() but without resolving any files in memory.
+    """
+    banner = f'{XML_FILE_HEADER}\n{INJECTION_FILE_HEADER.format(filename=src.filename)}'
+    for chunk in _iter_resolved(src, sources):
+        # The header cannot be split between chunks: chunks only end at <inject/> tags.
+        yield chunk.replace(XML_FILE_HEADER, banner)
+
 
-    working_filepaths = []
+def _iter_resolved(src: 'SourceFile', sources: Dict[str, 'SourceFile']) -> Iterator[str]:
+    """
+    Yield the resolved text of src in chunks, with each <inject/> tag expanded recursively.
+
+    Injections are expanded with an explicit stack, like SourceGraph.order(), so there
+    is no limit on nesting depth. Each chunk is passed through the _FragmentFilter of
+    every fragment it is nested in, innermost first.
+    """
+    frames = [(src, _iter_pieces(src), None)]
+
+    while frames:
+        parent, pieces, fragment = frames[-1]
+        piece = next(pieces, None)
+        if piece is None:
+            # All of the file at the top of the stack has been expanded.
+            frames.pop()
+            if fragment is not None:
+                chunks = fragment.close() + [INJECTION_MESSAGE_END.format(filename=parent.filename)]
+                yield from _filter_chunks(chunks, frames)
+            continue
+
+        if isinstance(piece, str):
+            if piece:
+                yield from _filter_chunks([piece], frames)
+            continue
+
+        # Equivalent to SourceFile.get_fragment() for the injected file.
+        child = _get_tag_source(parent, piece, sources)
+        stats.current().count('tags_expanded')
+        yield from _filter_chunks([INJECTION_MESSAGE_START.format(filename=child.filename)], frames)
+
+        wrapped = child._get_scan().wrapped
+        if wrapped:
+            frames.append((child, _iter_pieces(child, *wrapped), _FragmentFilter(None, piece.params)))
+        else:
+            frames.append((child, _iter_pieces(child), _FragmentFilter(piece.indent, piece.params)))
+
+
+def _iter_pieces(
+        src: 'SourceFile',
+        start: int = 0,
+        end: Optional[int] = None,
+) -> Iterator[Union[str, 'MergeTag']]:
+    """Yield the text of src between start and end in chunks, with a MergeTag in place of each <inject/> tag."""
+    tags = [] if src.resolved else src.get_merge_tags()
+    end = len(src.text) if end is None else end
+
+    position = start
+    for t in tags:
+        if t.start < start or t.end > end:
+            continue
+        yield src.text[position:t.start]
+        yield t
+        position = t.end
+    yield src.text[position:end]
+
+
+def _filter_chunks(chunks: List[str], frames: List[tuple]) -> List[str]:
+    """Pass chunks through the filters of the given stack of fragments, innermost first."""
+    for _, _, fragment in reversed(frames):
+        if fragment is not None:
+            chunks = fragment.feed(chunks)
+    return chunks
+
+
+class _FragmentFilter:
+    """
+    Turns the chunks of an injected file into the chunks of its fragment, equivalent to
+    _get_generic_content() (unless indent is None) followed by Template.render().
+    """
 
-    for f in xml_files:
-        filename = os.path.basename(f)
-        newpath = shutil.copy(f, os.path.join(TEMP_DIR, filename))
-        working_filepaths.append(newpath)
+    __slots__ = ('indent', 'params', 'pending')
 
-    return working_filepaths
+    def __init__(self, indent: Optional[int], params: Optional[Mapping[str, str]]):
+        self.indent = indent
+        self.params = params
+        self.pending = ''
+
+    def feed(self, chunks: List[str]) -> List[str]:
+        if self.indent is not None:
+            lines = []
+            for chunk in chunks:
+                *complete, self.pending = (self.pending + chunk).split('\n')
+                lines.extend(self._indented(f'{line}\n') for line in complete)
+            chunks = [line for line in lines if line]
+        return self._render(chunks)
+
+    def close(self) -> List[str]:
+        """Return the chunks still held back at the end of the file."""
+        pending, self.pending = self.pending, ''
+        if self.indent is None or not pending:
+            return []
+        line = self._indented(pending)
+        return self._render([line]) if line else []
+
+    def _indented(self, line: str) -> Optional[str]:
+        stripped = _stripped(line)
+        if stripped:
+            return _get_indented_line(stripped, self.indent)
+
+    def _render(self, chunks: List[str]) -> List[str]:
+        if not self.params:
+            return chunks
+        # Placeholders cannot be split between chunks: chunks only end at <inject/> tags or line breaks.
+        return [Template(chunk).render(self.params) for chunk in chunks]
+
+
+def _get_output_filename(src: 'SourceFile') -> str:
+    return src.filename.replace(MERGE_FILE_PREFIX, '', 1)
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _build_sourcemap(source_files: Iterable['SourceFile']) -> Dict['str', 'SourceFile']:
+    return {
+        sourcefile.key: sourcefile for sourcefile in source_files
+    }
 
 
-def _clean_up():
-    if os.path.exists(TEMP_DIR):
-        for f in os.listdir(TEMP_DIR):
-            os.remove(os.path.join(TEMP_DIR, f))
-        os.rmdir(TEMP_DIR)
+def _parse_sourcesets(value: str) -> List[str]:
+    import argparse
+
+    sourcesets = [x.strip() for x in value.split(',') if x.strip()]
+    for sourceset in sourcesets:
+        if sourceset not in SOURCESETS:
+            raise argparse.ArgumentTypeError(f'invalid sourceset \'{sourceset}\' (choose from {", ".join(SOURCESETS)})')
+    return sourcesets
+
+
+def _parse_qualifiers(value: str) -> List[str]:
+    import argparse
+
+    qualifiers = [x.strip().lstrip('-') for x in value.split(',') if x.strip()]
+    for qualifier in qualifiers:
+        if not re.fullmatch(r'[\w-]+', qualifier):
+            raise argparse.ArgumentTypeError(f'invalid resource qualifier \'{qualifier}\'')
+    return list(dict.fromkeys(qualifiers))
 
 
 def _parse_args():
+    import argparse
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
         'root',
-        default='.',
+        nargs='+',
+        help=(
+            'Directories to search for Android modules.'
+        )
     )
 
     parser.add_argument(
         '--source',
-        type=str,
-        default='main',
-        choices=['main', 'debug', 'test', 'androidTest'],
+        type=_parse_sourcesets,
+        default=['main'],
         help=(
-            'Which Android sourceset to use.'
+            'Which Android sourceset(s) to use, separated by commas e.g. main,debug. '
+            f'Choose from {", ".join(SOURCESETS)}.'
+        )
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        help=(
+            'Glob pattern for directories that should not be searched for source files, '
+            'matched against the directory name or its path relative to root. Can be repeated. '
+            f'Hidden directories and {", ".join(sorted(EXCLUDED_DIRS))} are always excluded.'
+        )
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=None,
+        help=(
+            'Maximum number of module sourcesets to merge in parallel. '
+            'Defaults to the number of CPUs.'
         )
     )
 
@@ -299,44 +1493,288 @@ def _parse_args():
         )
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help=(
+            'Only rebuild outputs whose source or injected dependencies have changed '
+            f'since the last run, as recorded in {CACHE_FILENAME} in the sourceset directory.'
+        ),
+    )
+
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='table',
+        choices=['table', 'json'],
+        help=(
+            'Print time spent in each phase, file and byte counts, and the slowest '
+            'files to resolve. Printed as a table unless `json` is given.'
+        ),
+    )
 
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='FILE',
+        help=(
+            'Write cProfile data for the run to FILE, e.g. for use with snakeviz or pstats. '
+            'Sourcesets are merged in a single process when profiling.'
+        ),
+    )
 
-def main():
-    _args = _parse_args()
-    _merge_sources_for_directory(_args.root, _args.source, _args.resdir, _args.keep_transitive)
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        default=False,
+        help=(
+            'Keep running and rebuild affected outputs whenever a source file changes.'
+        ),
+    )
 
+    parser.add_argument(
+        '--poll',
+        action='store_true',
+        default=False,
+        help=(
+            'With --watch, check for changes by polling instead of using inotify.'
+        ),
+    )
 
-if __name__ == '__main__':
-    main()
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help=(
+            'Rebuild every output, even with --incremental.'
+        ),
+    )
+
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help=(
+            'Write each output in chunks as it is expanded instead of building it in memory.'
+            ' Uses less memory for very large outputs, but shared files are expanded again for each use.'
+        ),
+    )
 
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        default=False,
+        help=(
+            'Check that the outputs on disk are up to date with their sources without writing anything. '
+            'Lists any outputs that are out of date and exits with an error if there are any.'
+        ),
+    )
 
-def _get_wrapped_content(file) -> Optional[str]:
+    parser.add_argument(
+        '--parser',
+        choices=PARSERS,
+        default=PARSERS[0],
+        help=(
+            'How to find <inject/> tags in source files. `regex` (default) treats files as plain text. '
+            '`xml` parses them as XML, so tags are found anywhere outside of comments and nested unwrap '
+            'elements are handled correctly, but every source file must be well-formed.'
+        ),
+    )
+
+    parser.add_argument(
+        '--qualifiers',
+        type=_parse_qualifiers,
+        default=[],
+        help=(
+            'Resource qualifiers to also write outputs for, separated by commas e.g. land,sw600dp. '
+            'Outputs for land are written to res/xml-land, using any source files in e.g. res/xml-land/_*.xml '
+            'in place of those with the same name. Files which are not overridden are only resolved once.'
+        ),
+    )
+
+    parser.add_argument(
+        '--report',
+        choices=['json'],
+        help=(
+            'Print a report of every output when finished: its path, source, the files it includes, size, '
+            'time taken and whether it was written, skipped or removed. '
+            'A sourceset which cannot be merged is reported with its error and no outputs.'
+        ),
+    )
+
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        default=False,
+        help=(
+            'Log progress and a summary of each sourceset. By default only warnings and errors are logged.'
+        ),
+    )
+
+    args = parser.parse_args()
+    for option in ['check', 'qualifiers', 'report']:
+        if getattr(args, option) and args.watch:
+            parser.error(f'--{option} cannot be used with --watch')
+    return args
+
+
+def main():
+    if not log.handlers:
+        log.addHandler(logging.StreamHandler())
+
+    if sys.argv[1:2] == ['graph']:
+        # Subcommand - use e.g. `scenemerge ./graph` to merge a directory called graph.
+        from motionscene_merger import graph
+        graph.main(sys.argv[2:])
+        return
+
+    _args = _parse_args()
+    # Messages below WARNING are not even formatted unless --verbose is given.
+    log.setLevel(logging.INFO if _args.verbose else logging.WARNING)
+
+    profiler = None
+    if _args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        failures = _run(_args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(_args.profile)
+            log.info(f'Profile written to {_args.profile}')
+
+    # Stdout is reserved for the report, if any, so that it can be parsed.
+    stats_file = sys.stderr if _args.report else sys.stdout
+    if _args.stats == 'json':
+        print(stats.current().to_json(), file=stats_file)
+    elif _args.stats:
+        print(stats.current().to_table(), file=stats_file)
+
+    if failures:
+        sys.exit(1)
+
+
+def _run(_args) -> int:
+    """Merge everything requested by the commandline arguments, returning the number of failed sourcesets."""
+    with stats.current().phase('discovery'):
+        source_sets = [
+            source_set
+            for root in _args.root
+            for source_set in _find_source_sets(root, _args.source, _args.resdir, _args.exclude)
+        ]
+
+    if _args.watch:
+        from motionscene_merger.watch import watch
+        watch(source_sets, _args.keep_transitive, polling=_args.poll, parser=_args.parser)
+        return 0
+
+    results = _merge_source_sets(
+        source_sets,
+        # Worker processes are not included in the profile.
+        jobs=1 if _args.profile else _args.jobs,
+        keep_transitive=_args.keep_transitive,
+        incremental=_args.incremental,
+        force=_args.force,
+        stream=_args.stream,
+        check=_args.check,
+        parser=_args.parser,
+        qualifiers=_args.qualifiers,
+        report=bool(_args.report),
+    )
+
+    failures = 0
+    for source_set, result, error in results:
+        if error:
+            failures = failures + 1
+            log.error(f'{source_set}: {error}')
+        elif _args.check and result.changes:
+            failures = failures + 1
+            log.error(f'{source_set}: {len(result.changes)} outputs are out of date')
+            for output_filename, change in sorted(result.changes.items()):
+                log.error(f'    {output_filename}: {change}')
+        elif _args.check:
+            log.info(f'{source_set}: {len(result.unchanged)} outputs are up to date')
+        else:
+            log.info(f'{source_set}: {result}')
+
+    if _args.report == 'json':
+        print(json.dumps(_get_report(results), indent=2))
+
+    return failures
+
+
+def _get_report(results: List[Tuple['SourceSet', Optional['MergeResult'], Optional[str]]]) -> List[dict]:
+    """Describe every output of each SourceSet for --report, as returned by _merge_source_sets(report=True)."""
+    return [
+        {
+            'sourceset': str(source_set),
+            'error': error,
+            'outputs': [
+                {'output': output_filename, **record}
+                for output_filename, record in sorted(result.records.items())
+            ] if result else [],
+        }
+        for source_set, result, error in results
+    ]
+
+
+def _get_wrapped_content(content: str) -> Optional[str]:
     """
     Return any content that lies within any of the tags defined in UNWRAP_TAGS.
     e.g. <MotionScene>...</MotionScene>
     """
-    file.seek(0)
-    content = file.read()
-    for tag in UNWRAP_TAGS:
-        match = re.match(
-            pattern=UNWRAP_PATTERN.format(tag=tag),
-            string=content,
-            flags=re.DOTALL
-        )
-        if match:
-            return match.group(1)
+    wrapped = _scan(content).wrapped
+    if wrapped:
+        return content[wrapped[0]:wrapped[1]]
 
 
-def _get_generic_content(file, indent) -> str:
-    file.seek(0)
-    content = ''
-    for line in file.readlines():
-        stripped = _stripped(line)
+def _get_generic_content(text: str, indent) -> str:
+    """
+    Return text with IGNORED_LINES removed and each remaining line indented.
+
+    Only the lines which contain one of IGNORED_LINES are looked at individually.
+    Everything between them is indented with a single replace().
+    """
+    prefix = ' ' * indent
+    parts = []
+    position = 0
+    for start, end in _find_ignored_lines(text):
+        parts.append(_indent_lines(text[position:start], prefix))
+        stripped = _stripped(text[start:end])
         if stripped:
-            content = content + _get_indented_line(stripped, indent)
+            parts.append(prefix)
+            parts.append(stripped)
+        position = end
+    parts.append(_indent_lines(text[position:], prefix))
+
+    return ''.join(parts)
+
+
+def _find_ignored_lines(text: str) -> List[Tuple[int, int]]:
+    """Return the (start, end) offsets of each line in text that contains any of IGNORED_LINES, in order."""
+    lines = set()
+    for ignored in IGNORED_LINES:
+        i = text.find(ignored)
+        while i >= 0:
+            start = text.rfind('\n', 0, i) + 1
+            end = text.find('\n', i)
+            end = len(text) if end < 0 else end + 1
+            lines.add((start, end))
+            i = text.find(ignored, end)
+    return sorted(lines)
 
-    return content
+
+def _indent_lines(text: str, prefix: str) -> str:
+    """Add prefix to the start of every line in text."""
+    if not text:
+        return ''
+    body, newline = (text[:-1], '\n') if text.endswith('\n') else (text, '')
+    return prefix + body.replace('\n', f'\n{prefix}') + newline
 
 
 def _get_indented_line(content, indent):
@@ -349,9 +1787,15 @@ def _stripped(line):
         if ignored in line:
             content = line.replace(ignored, '').strip()
             if content:
-                log.info(f'{line.strip()} -> {content}')
                 return content
             else:
                 return None
 
     return line
+
+
+if __name__ == '__main__':
+    # Run the copy of this module that the rest of the package imports, so that
+    # watch and graph share its logger and caches.
+    from motionscene_merger import scenemerge
+    scenemerge.main()
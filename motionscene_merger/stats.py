@@ -0,0 +1,102 @@
+"""
+Timing and counters for a scenemerge run.
+
+Merge functions record what they do on the RunStats returned by current().
+Use collect() to gather the stats for one piece of work separately, e.g. in a
+worker process, and RunStats.merge() to combine them afterwards.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Dict,
+    Iterator,
+)
+
+SLOWEST_FILES = 10  # Number of files listed in the report.
+
+
+class RunStats:
+    def __init__(self):
+        self.phases: Dict[str, float] = {}  # Phase name -> total seconds
+        self.counters: Dict[str, int] = {}
+        self.file_times: Dict[str, float] = {}  # Path -> seconds spent resolving
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the wall time of the enclosed block to the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def time_file(self, path: str, seconds: float):
+        self.file_times[path] = self.file_times.get(path, 0) + seconds
+
+    def merge(self, other: 'RunStats'):
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0) + seconds
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for path, seconds in other.file_times.items():
+            self.time_file(path, seconds)
+
+    def slowest_files(self, n: int = SLOWEST_FILES):
+        return sorted(self.file_times.items(), key=lambda x: x[1], reverse=True)[:n]
+
+    def to_dict(self) -> dict:
+        return {
+            'phases': self.phases,
+            'counters': self.counters,
+            'slowest_files': [{'path': path, 'seconds': seconds} for path, seconds in self.slowest_files()],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_table(self) -> str:
+        lines = []
+        total = sum(self.phases.values())
+        lines.append(f'{"phase":<24}{"time":>12}{"":>8}')
+        for name, seconds in self.phases.items():
+            share = seconds / total if total else 0
+            lines.append(f'{name:<24}{seconds * 1000:>10.2f}ms{share:>8.1%}')
+
+        if self.counters:
+            lines.append('')
+            for name, n in sorted(self.counters.items()):
+                lines.append(f'{name:<24}{n:>12}')
+
+        slowest = self.slowest_files()
+        if slowest:
+            lines.append('')
+            lines.append('slowest files')
+            for path, seconds in slowest:
+                lines.append(f'{seconds * 1000:>10.2f}ms  {path}')
+
+        return '\n'.join(lines)
+
+
+# Each thread (and asyncio task) has its own current RunStats while inside collect().
+_current: ContextVar[RunStats] = ContextVar('scenemerge_stats', default=RunStats())
+
+
+def current() -> RunStats:
+    return _current.get()
+
+
+@contextmanager
+def collect() -> Iterator[RunStats]:
+    """Record stats for the enclosed block on a new RunStats instead of the current one."""
+    run_stats = RunStats()
+    token = _current.set(run_stats)
+    try:
+        yield run_stats
+    finally:
+        _current.reset(token)
@@ -0,0 +1,222 @@
+"""
+Storage used by scenemerge for reading source files and writing outputs.
+
+All file access during a merge goes through the Storage returned by current().
+FileStorage uses the real filesystem and is the default. Use use() to merge
+with a different Storage for the enclosed block, e.g. a MemoryStorage to merge
+without any disk I/O. The current Storage is kept separately for each thread.
+"""
+
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+)
+
+from motionscene_merger import stats
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - output directories are not locked.
+    fcntl = None
+
+READ_CHUNK_SIZE = 64 * 1024  # Characters returned at a time by read_chunks().
+
+
+class Storage:
+    """Interface for file access. Paths are opaque strings joined with os.path."""
+    def read(self, path: str) -> str:
+        """Return the content of path. Raises OSError if it cannot be read."""
+        raise NotImplementedError()
+
+    def read_chunks(self, path: str) -> Iterator[str]:
+        """Yield the content of path a piece at a time. Raises OSError if it cannot be read."""
+        yield self.read(path)
+
+    def write(self, path: str, content: str):
+        raise NotImplementedError()
+
+    def write_chunks(self, path: str, chunks: Iterable[str]):
+        self.write(path, ''.join(chunks))
+
+    def remove(self, path: str):
+        """Remove path. Raises OSError if it does not exist."""
+        raise NotImplementedError()
+
+    def makedirs(self, path: str):
+        """Create the directory path, and any parents, if it does not already exist."""
+        raise NotImplementedError()
+
+    @contextmanager
+    def lock(self, path: str):
+        """
+        Hold an exclusive lock on the directory path for the enclosed block, so
+        that concurrent merges into the same directory happen one at a time.
+        """
+        yield
+
+
+class FileStorage(Storage):
+    """
+    Files on the real filesystem. Reads and writes are recorded in the current RunStats.
+
+    Files are written atomically: content is written to a temporary file in the
+    same directory which then replaces the target, so other processes never see
+    a partially written file. Directories are locked with flock() where available.
+    """
+    def read(self, path: str) -> str:
+        with open(path, 'r') as f:
+            self._count_read(f)
+            return f.read()
+
+    def read_chunks(self, path: str) -> Iterator[str]:
+        with open(path, 'r') as f:
+            self._count_read(f)
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), ''):
+                yield chunk
+
+    def write(self, path: str, content: str):
+        self.write_chunks(path, [content])
+
+    def write_chunks(self, path: str, chunks: Iterable[str]):
+        import tempfile
+
+        directory, filename = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.tmp', dir=directory or None)
+        try:
+            with open(fd, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                run_stats = stats.current()
+                run_stats.count('file_opens')
+                run_stats.count('bytes_written', f.tell())
+            os.chmod(temp_path, _get_file_mode(path))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def remove(self, path: str):
+        os.remove(path)
+
+    def makedirs(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def lock(self, path: str):
+        if fcntl is None:
+            yield
+            return
+
+        self.makedirs(path)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                stats.current().count('lock_waits')
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the lock.
+            os.close(fd)
+
+    def _count_read(self, f):
+        run_stats = stats.current()
+        run_stats.count('file_opens')
+        run_stats.count('bytes_read', os.fstat(f.fileno()).st_size)
+
+
+class MemoryStorage(Storage):
+    """Files held in a dictionary of path -> content. Directories are implicit."""
+    def __init__(self, files: Optional[Dict[str, str]] = None):
+        self.files: Dict[str, str] = dict(files or {})
+
+    def read(self, path: str) -> str:
+        try:
+            return self.files[path]
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def write(self, path: str, content: str):
+        self.files[path] = content
+
+    def remove(self, path: str):
+        self.read(path)
+        del self.files[path]
+
+    def makedirs(self, path: str):
+        pass
+
+
+class DryRunStorage(Storage):
+    """
+    Reads from another Storage, but keeps anything written or removed in memory
+    so that the files in the underlying Storage are never changed.
+    """
+    def __init__(self, base: 'Storage'):
+        self.base = base
+        self.written: Dict[str, str] = {}  # Path -> content that would have been written.
+        self.removed: Set[str] = set()  # Paths that would have been removed.
+
+    def read(self, path: str) -> str:
+        if path in self.removed:
+            raise FileNotFoundError(path)
+        if path in self.written:
+            return self.written[path]
+        return self.base.read(path)
+
+    def read_chunks(self, path: str) -> Iterator[str]:
+        if path in self.removed or path in self.written:
+            yield self.read(path)
+        else:
+            yield from self.base.read_chunks(path)
+
+    def write(self, path: str, content: str):
+        self.written[path] = content
+        self.removed.discard(path)
+
+    def remove(self, path: str):
+        self.read(path)
+        self.written.pop(path, None)
+        self.removed.add(path)
+
+    def makedirs(self, path: str):
+        pass
+
+
+def _get_file_mode(path: str) -> int:
+    """Return the permissions of the existing file at path, or the default permissions for a new file."""
+    try:
+        return os.stat(path).st_mode & 0o777
+    except OSError:
+        pass
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Each thread (and asyncio task) has its own current Storage while inside use(),
+# so that merges in different threads do not see each other's files.
+_current: ContextVar['Storage'] = ContextVar('scenemerge_storage', default=FileStorage())
+
+
+def current() -> 'Storage':
+    return _current.get()
+
+
+@contextmanager
+def use(storage: 'Storage') -> Iterator['Storage']:
+    """Use the given Storage for all file access within the enclosed block, in the current thread."""
+    token = _current.set(storage)
+    try:
+        yield storage
+    finally:
+        _current.reset(token)
@@ -0,0 +1,246 @@
+"""
+Long-running watch mode for scenemerge.
+
+The source graph is kept in memory between changes. When a source file changes,
+only that file and the files which (directly or transitively) inject it are
+reloaded and merged again - every other file keeps its resolved content.
+
+Changes are detected with inotify on Linux. On other platforms, or if inotify
+is unavailable, the source directories are polled instead.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+from motionscene_merger import storage
+from motionscene_merger.scenemerge import (
+    MERGE_FILE_PREFIX,
+    PARSERS,
+    BuildCache,
+    MergeResult,
+    SourceFile,
+    SourceGraph,
+    SourceSet,
+    _build_sourcemap,
+    _get_source_key,
+    _merge_sources,
+    log,
+)
+
+POLL_INTERVAL = 0.5  # Seconds between checks when polling for changes.
+DEBOUNCE_INTERVAL = 0.05  # Seconds to wait for related events before merging.
+
+
+class WatchSession:
+    """In-memory source graph for a single SourceSet, updated as files change."""
+    def __init__(self, source_set: 'SourceSet', keep_transitive=False, parser: str = PARSERS[0]):
+        self.source_set = source_set
+        self.keep_transitive = keep_transitive
+        self.parser = parser
+        self.output_dir = source_set.output_dir
+
+        self.raw: Dict[str, str] = {}  # Original content of each source file, keyed by path.
+        self.files: Dict[str, SourceFile] = {}  # Keyed by path.
+        for path in source_set.filepaths:
+            self.files[path] = SourceFile(path, parser=parser)
+            self.raw[path] = self.files[path].text
+
+        self.source_dirs = sorted({os.path.dirname(path) for path in self.files})
+
+    def merge_all(self) -> 'MergeResult':
+        return self._merge()
+
+    def update(self, changed_paths: Set[str]) -> Optional['MergeResult']:
+        """
+        Reload the given paths and rebuild any outputs that depend on them.
+        Returns None if none of the files actually changed.
+        """
+        changed = set()
+        for path in changed_paths:
+            try:
+                with open(path, 'r') as f:
+                    text = f.read()
+            except OSError:
+                # File was removed.
+                if self.files.pop(path, None) is not None:
+                    del self.raw[path]
+                    changed.add(_get_source_key(path))
+                continue
+
+            if self.raw.get(path) == text:
+                continue
+            self.raw[path] = text
+            self.files[path] = SourceFile(path, text, self.parser)
+            changed.add(_get_source_key(path))
+
+        if not changed:
+            return None
+
+        # Any file that has already been resolved with content from a changed
+        # file must be reloaded so that it can be resolved again.
+        graph = SourceGraph(_build_sourcemap(self.files.values()))
+        stale = graph.dependents(graph.get_ids(changed))
+        for path, f in self.files.items():
+            if f.resolved and graph.ids[f.key] in stale:
+                self.files[path] = SourceFile(path, self.raw[path], self.parser)
+
+        return self._merge(changed)
+
+    def _merge(self, changed: Optional[Set[str]] = None) -> 'MergeResult':
+        with storage.current().lock(self.output_dir):
+            # Reloaded every time in case another run has changed it meanwhile.
+            cache = BuildCache.load(self.source_set.cache_path)
+            return _merge_sources(list(self.files.values()), self.output_dir, self.keep_transitive, cache, changed)
+
+
+def watch(source_sets: List['SourceSet'], keep_transitive=False, polling=False, parser: str = PARSERS[0]):
+    """Merge everything once, then keep merging affected files as they change until interrupted."""
+    sessions = {}  # Source directory -> WatchSession
+    for source_set in source_sets:
+        session = WatchSession(source_set, keep_transitive, parser)
+        log.info(f'{source_set}: {session.merge_all()}')
+        for d in session.source_dirs:
+            sessions[d] = session
+
+    monitor = _open_monitor(sorted(sessions.keys()), polling)
+    log.info(f'Watching {len(sessions)} directories for changes (Ctrl+C to stop)...')
+    try:
+        while True:
+            changed_paths = monitor.wait()
+
+            grouped = {}
+            for path in changed_paths:
+                grouped.setdefault(sessions[os.path.dirname(path)], set()).add(path)
+
+            for session, paths in grouped.items():
+                try:
+                    result = session.update(paths)
+                except Exception as e:
+                    log.error(f'{session.source_set}: Merge failed: {e}')
+                    continue
+
+                if result is not None:
+                    log.info(f'{session.source_set}: {result}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+
+
+def _is_source_filename(filename: str) -> bool:
+    return filename.startswith(MERGE_FILE_PREFIX) and filename.endswith('.xml')
+
+
+def _open_monitor(directories: List[str], polling=False):
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyMonitor(directories)
+        except OSError as e:
+            log.info(f'inotify unavailable ({e}), falling back to polling')
+    return PollingMonitor(directories)
+
+
+class PollingMonitor:
+    """Detect changes by comparing the size and mtime of source files at regular intervals."""
+    def __init__(self, directories: List[str], interval: float = POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> Dict[str, tuple]:
+        snapshot = {}
+        for d in self.directories:
+            try:
+                entries = list(os.scandir(d))
+            except OSError:
+                continue
+            for entry in entries:
+                if _is_source_filename(entry.name):
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self) -> Set[str]:
+        """Return the paths that have been added, modified or removed since the last call."""
+        snapshot = self._take_snapshot()
+        changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self) -> Set[str]:
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor:
+    """Receive change events for source directories from the Linux kernel via inotify."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self, directories: List[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.watches = {}  # Watch descriptor -> directory
+        for d in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(d), self.MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, f'inotify_add_watch failed for {d}')
+            self.watches[wd] = d
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if wd in self.watches and _is_source_filename(name):
+                changed.add(os.path.join(self.watches[wd], name))
+        return changed
+
+    def wait(self) -> Set[str]:
+        while True:
+            select.select([self.fd], [], [])
+            changed = self._read_events()
+
+            # Editors often save with several operations (write, rename, chmod...)
+            # so collect anything else that arrives shortly afterwards.
+            while select.select([self.fd], [], [], DEBOUNCE_INTERVAL)[0]:
+                changed |= self._read_events()
+
+            if changed:
+                return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,184 @@
+"""
+XML-aware alternative to the pattern-based scanner in scenemerge.
+
+Source files are parsed with expat, so <inject/> elements are found wherever
+they are in the document and anything inside comments or CDATA is ignored.
+The unwrapped content is that of the outermost element listed in UNWRAP_TAGS,
+however many elements of the same name are nested inside it.
+
+Positions of elements are taken from the parser, so like the default scanner
+this works in a single linear pass over the text.
+"""
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+from motionscene_merger.scenemerge import (
+    UNWRAP_TAGS,
+    MergeTag,
+    ScanResult,
+)
+
+INJECT_TAG = 'inject'
+FRAGMENT_TAG = 'scenemerge-fragment'  # Wraps source files which have no XML declaration.
+
+
+class XmlScanError(ValueError):
+    """Raised when a source file is not well-formed XML."""
+
+
+def scan(text: str) -> 'ScanResult':
+    """
+    Find all <inject/> elements and the wrapped content region of text.
+    Equivalent to scenemerge._scan(), but for well-formed XML only.
+    """
+    # Files without a declaration are often fragments with several top-level
+    # elements, so are parsed inside an extra root element.
+    prefix = '' if text.lstrip().startswith('<?xml') else f'<{FRAGMENT_TAG}>'
+    suffix = f'</{FRAGMENT_TAG}>' if prefix else ''
+    data = f'{prefix}{text}{suffix}'.encode('utf-8')
+
+    parser = expat.ParserCreate(encoding='utf-8')
+    handler = _ScanHandler(parser, data, 2 if prefix else 1)
+
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        raise XmlScanError(f'Invalid XML at line {e.lineno}, column {e.offset}: {expat.errors.messages[e.code]}') from None
+
+    # Convert positions in the encoded data to positions in text.
+    offsets = _get_char_offsets(data, handler.get_offsets(), len(prefix))
+
+    tags = []
+    for start, end, src, params in handler.injects:
+        tag_start, tag_end = offsets[start], offsets[end]
+        line_start = text.rfind('\n', 0, tag_start) + 1
+        indent = text[line_start:tag_start]
+        if indent.strip():
+            # Other content before the tag on the same line - only replace the tag itself.
+            line_start, indent = tag_start, ''
+
+        tags.append(MergeTag(
+            tag=text[line_start:tag_end],
+            src=src,
+            indent=len(indent),
+            start=line_start,
+            end=tag_end,
+            params=params,
+        ))
+
+    wrapped = None
+    if handler.wrapped:
+        wrapped = (offsets[handler.wrapped[0]], offsets[handler.wrapped[1]])
+
+    return ScanResult(tags, wrapped)
+
+
+class _ScanHandler:
+    """Receives events from expat and records the byte positions of <inject/> and unwrap elements."""
+    def __init__(self, parser, data: bytes, top_level: int):
+        self.parser = parser
+        self.data = data
+        self.top_level = top_level  # Depth of top-level elements in the source file.
+        self.depth = 0
+
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+
+        self.injects: List[Tuple[int, int, str, Dict[str, str]]] = []  # (start, end, src, params)
+        self.wrapped: Optional[Tuple[int, int]] = None
+
+        self._inject: Optional[Tuple[int, str, Dict[str, str], int]] = None  # (start, src, params, depth)
+        self._unwrap_depth = 0  # Depth of the element being unwrapped, if any.
+        self._content_start: Optional[int] = None
+        self._awaiting_content = False  # True until the end of the current unwrap start tag is known.
+
+    def get_offsets(self) -> List[int]:
+        offsets = [x for start, end, _, _ in self.injects for x in [start, end]]
+        if self.wrapped:
+            offsets += list(self.wrapped)
+        return offsets
+
+    def _position(self) -> int:
+        position = self.parser.CurrentByteIndex
+        if self._awaiting_content:
+            # This is the first event after the unwrap start tag, so it begins where that tag ends.
+            self._set_content_handlers(None)
+            self._awaiting_content = False
+            self._content_start = position
+        return position
+
+    def _set_content_handlers(self, handler):
+        # Text, comments etc. are only of interest to find the end of an unwrap
+        # start tag, so the parser does not call back for them the rest of the time.
+        self.parser.CharacterDataHandler = handler
+        self.parser.CommentHandler = handler
+        self.parser.ProcessingInstructionHandler = handler
+        self.parser.StartCdataSectionHandler = handler
+
+    def start(self, name: str, attrs: Dict[str, str]):
+        position = self._position()
+        self.depth += 1
+
+        if name == INJECT_TAG and self._inject is None:
+            src = attrs.get('src')
+            if src is None:
+                raise XmlScanError(f'<inject> without src attribute at line {self.parser.CurrentLineNumber}')
+            # Parameter values are inserted into XML, so must stay escaped as they were in the source.
+            params = {name: escape(value, {'"': '&quot;'}) for name, value in attrs.items() if name != 'src'}
+            self._inject = (position, src, params, self.depth)
+        elif (
+            name in UNWRAP_TAGS
+            and self.depth == self.top_level
+            and not self._unwrap_depth
+            and self.wrapped is None
+        ):
+            self._unwrap_depth = self.depth
+            self._awaiting_content = True
+            self._set_content_handlers(self.other)
+
+    def end(self, name: str):
+        position = self._position()
+
+        if self._inject is not None and self.depth == self._inject[3]:
+            # Anything inside an <inject> element is ignored.
+            start, src, params, _ = self._inject
+            if self._is_end_tag(name, position):
+                position = self.data.index(b'>', position) + 1
+            self.injects.append((start, position, src, params))
+            self._inject = None
+        elif self._unwrap_depth == self.depth:
+            self._unwrap_depth = 0
+            if self._is_end_tag(name, position):
+                # Otherwise this was an empty element e.g. <merge/> which has no content.
+                self.wrapped = (self._content_start, position)
+
+        self.depth -= 1
+
+    def other(self, *args):
+        self._position()
+
+    def _is_end_tag(self, name: str, position: int) -> bool:
+        """
+        True if the end of element name was reported at an end tag, e.g. </merge>.
+        For empty elements e.g. <merge/> it is reported at the end of the start tag instead.
+        """
+        return self.data.startswith(f'</{name}'.encode('utf-8'), position)
+
+
+def _get_char_offsets(data: bytes, byte_offsets: List[int], prefix_length: int) -> Dict[int, int]:
+    """Map each byte offset into data to the corresponding character offset into the original text."""
+    offsets = {}
+    position = 0
+    chars = -prefix_length
+    for offset in sorted(set(byte_offsets)):
+        chars += len(data[position:offset].decode('utf-8'))
+        position = offset
+        offsets[offset] = chars
+    return offsets
@@ -28,5 +28,5 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
     ],
-    python_requires='>=3.6',  # May work in earlier versions but only actually tested on 3.8
+    python_requires='>=3.8',  # contextvars and module __getattr__ need 3.7, the tests need 3.8
 )
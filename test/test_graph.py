@@ -0,0 +1,124 @@
+"""
+
+"""
+
+import io
+import json
+import os
+import tempfile
+from contextlib import redirect_stdout
+from typing import Dict
+from unittest import TestCase
+
+from motionscene_merger import graph
+from motionscene_merger.graph import InjectGraph
+from motionscene_merger.scenemerge import SourceFile
+from test_scenemerge import _write_source_tree
+
+
+def _build_graph(files: Dict[str, str], keep_transitive=False) -> 'InjectGraph':
+    return InjectGraph([SourceFile(name, text) for name, text in files.items()], keep_transitive)
+
+
+FILES = {
+    '_scene_one.xml': '<merge>\n    <inject src="_group"/>\n    <inject src="_leaf"/>\n</merge>\n',
+    '_scene_two.xml': '<merge>\n    <inject src="_group"/>\n    <inject src="_group"/>\n</merge>\n',
+    '_scene_three.xml': '<merge>\n    <inject src="_other"/>\n</merge>\n',
+    '_group.xml': '<merge>\n    <inject src="_leaf"/>\n</merge>\n',
+    '_leaf.xml': '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n',
+    '_other.xml': '<merge>\n    <Constraint android:id="@+id/other"/>\n</merge>\n',
+}
+
+
+class GraphTestCase(TestCase):
+    def test_graph(self):
+        g = _build_graph(FILES)
+
+        self.assertListEqual(g.injects['_scene_two.xml'], ['_group.xml'])
+        self.assertListEqual(sorted(g.injected_by['_leaf.xml']), ['_group.xml', '_scene_one.xml'])
+        self.assertDictEqual(g.outputs, {
+            '_scene_one.xml': 'scene_one.xml',
+            '_scene_two.xml': 'scene_two.xml',
+            '_scene_three.xml': 'scene_three.xml',
+        })
+        self.assertEqual(g.depth['_scene_one.xml'], 2)
+        self.assertEqual(g.depth['_leaf.xml'], 0)
+
+    def test_rdeps(self):
+        g = _build_graph(FILES)
+
+        self.assertListEqual(g.rdeps('_leaf.xml'), ['scene_one.xml', 'scene_two.xml'])
+        self.assertListEqual(g.rdeps('_other.xml'), ['scene_three.xml'])
+        self.assertListEqual(g.rdeps('_scene_one.xml'), ['scene_one.xml'])
+
+        g = _build_graph(FILES, keep_transitive=True)
+        self.assertListEqual(g.rdeps('_leaf.xml'), ['group.xml', 'leaf.xml', 'scene_one.xml', 'scene_two.xml'])
+
+    def test_hotspots(self):
+        g = _build_graph(FILES)
+        self.assertListEqual(g.hotspots(2), ['_group.xml', '_leaf.xml'])
+
+    def test_formats(self):
+        g = _build_graph(FILES)
+
+        data = json.loads(json.dumps(g.to_dict()))
+        self.assertEqual(data['_leaf.xml']['fan_in'], 2)
+        self.assertEqual(data['_group.xml']['output'], None)
+
+        dot = g.to_dot()
+        self.assertTrue('"_scene_one.xml" [shape=box];' in dot)
+        self.assertTrue('"_group.xml" -> "_leaf.xml";' in dot)
+
+    def test_main_rdeps(self):
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, FILES)
+
+            out = io.StringIO()
+            with redirect_stdout(out):
+                graph.main([root, '--rdeps', '_group'])
+
+            self.assertListEqual(out.getvalue().splitlines(), [
+                os.path.join(xml_dir, 'scene_one.xml'),
+                os.path.join(xml_dir, 'scene_two.xml'),
+            ])
+            # Nothing is merged.
+            self.assertListEqual(sorted(os.listdir(xml_dir)), sorted(FILES))
+
+    def test_invalid_graphs_still_have_edges(self):
+        g = _build_graph({
+            '_scene.xml': '<merge>\n    <inject src="_a"/>\n</merge>\n',
+            '_a.xml': '<merge>\n    <inject src="_b"/>\n</merge>\n',
+            '_b.xml': '<merge>\n    <inject src="_a"/>\n</merge>\n',
+        })
+        self.assertTrue(g.error.startswith('InjectionCycleError: '))
+        self.assertListEqual(g.cycle, ['_a.xml', '_b.xml', '_a.xml'])
+        self.assertListEqual(g.injects['_b.xml'], ['_a.xml'])
+        self.assertIsNone(g.to_dict()['_scene.xml']['depth'])
+        dot = g.to_dot()
+        self.assertTrue('"_scene.xml" -> "_a.xml";' in dot)
+        self.assertTrue('"_b.xml" -> "_a.xml" [color=red];' in dot)
+
+        g = _build_graph({'_scene.xml': '<merge>\n    <inject src="_missing"/>\n</merge>\n'})
+        self.assertTrue(g.error.startswith('KeyError: '))
+        self.assertListEqual(g.missing, ['_missing.xml'])
+        self.assertTrue('"_scene.xml" -> "_missing.xml" [color=red];' in g.to_dot())
+
+    def test_main_reports_invalid_sourcesets(self):
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(root, FILES)
+            cycle = {'_scene.xml': '<merge>\n    <inject src="_scene"/>\n</merge>\n'}
+            _write_source_tree(root, cycle, sourceset='debug')
+
+            out = io.StringIO()
+            with redirect_stdout(out), self.assertLogs('motionscene_merger.scenemerge', 'ERROR') as logs:
+                with self.assertRaises(SystemExit) as e:
+                    graph.main([root, '--source', 'main,debug'])
+
+            self.assertEqual(e.exception.code, 1)
+            self.assertEqual(len(logs.output), 1)
+            self.assertTrue('Circular <inject/> dependency: _scene.xml -> _scene.xml' in logs.output[0])
+
+            data = {x['sourceset']: x for x in json.loads(out.getvalue())}
+            self.assertEqual(len(data), 2)
+            errors = sorted((x['error'] is None, x['cycle']) for x in data.values())
+            self.assertListEqual(errors, [(False, ['_scene.xml', '_scene.xml']), (True, [])])
@@ -2,18 +2,43 @@
 
 """
 
+import io
+import json
 import logging
 import os
-from unittest import TestCase
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Dict
+from unittest import TestCase, mock
 
 from motionscene_merger.scenemerge import (
+    CACHE_FILENAME,
     DEFAULT_SOURCE_RES_DIR,
+    PARSERS,
+    FragmentCache,
+    InjectionCycleError,
     SourceFile,
+    SourceGraph,
+    Template,
     _build_sourcemap,
+    _check_source_set,
     _find_merge_tags,
+    _find_source_sets,
+    _get_generic_content,
     _get_source_filepaths,
+    _get_wrapped_content,
+    _merge_source_set,
+    _merge_source_sets,
     _merge_sources_for_directory,
+    _parse_qualifiers,
+    _parse_sourcesets,
+    _scan,
+    merge,
 )
+from motionscene_merger import scenemerge
 
 log = logging.getLogger(__name__)
 
@@ -140,6 +165,16 @@ def _get_temp_path(filename: str):
     )
 
 
+def _write_source_tree(root: str, files: Dict[str, str], sourceset: str = 'main') -> str:
+    """Write files to {root}/{sourceset}/res/xml and return that directory."""
+    xml_dir = os.path.join(root, sourceset, 'res', 'xml')
+    os.makedirs(xml_dir, exist_ok=True)
+    for filename, content in files.items():
+        with open(os.path.join(xml_dir, filename), 'w') as f:
+            f.write(content)
+    return xml_dir
+
+
 def _clean_generated_files():
     for d in [TEST_TEMP_DIR, TEST_XML_DIR]:
         if os.path.exists(d):
@@ -149,6 +184,10 @@ def _clean_generated_files():
             if not os.listdir(d):
                 os.rmdir(d)
 
+    manifest_path = os.path.join(EXAMPLE_ROOT_DIR, 'main', CACHE_FILENAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
 
 class MergeTestCase(TestCase):
     """"""
@@ -227,16 +266,16 @@ class MergeTestCase(TestCase):
             sourcefile_two,
             sourcefile_three,
         ])
-        self.assertFalse(sources['_example_constraintset.xml'].resolved)
-        self.assertFalse(sources['_example_motion_scene_2.xml'].resolved)
+        self.assertFalse(sources['xml/_example_constraintset.xml'].resolved)
+        self.assertFalse(sources['xml/_example_motion_scene_2.xml'].resolved)
 
         sourcefile_one.resolve_injections(sources)
         self.assertTrue(sourcefile_one.resolved)
-        self.assertTrue(sources['_example_constraintset.xml'].resolved)
+        self.assertTrue(sources['xml/_example_constraintset.xml'].resolved)
 
         sourcefile_two.resolve_injections(sources)
         self.assertFalse(sourcefile_two.resolved)
-        self.assertFalse(sources['_example_motion_scene_2.xml'].resolved)
+        self.assertFalse(sources['xml/_example_motion_scene_2.xml'].resolved)
 
     def test_transitive_injections(self):
         expected_output_path = _get_xml_path('nested_1.xml')
@@ -257,3 +296,668 @@ class MergeTestCase(TestCase):
             content = f.read()
             self.assertTrue('<!--    <inject src="_example_constraintset"/>-->' in content)
             self.assertFalse('android:id="@+id/constraintset_two"/>' in content)
+
+    def test_deep_transitive_injections(self):
+        depth = 25
+        files = {
+            f'_level_{n}.xml': f'<merge>\n    <inject src="_level_{n + 1}"/>\n</merge>\n' for n in range(depth)
+        }
+        files[f'_level_{depth}.xml'] = '<merge>\n    <Constraint android:id="@+id/deepest"/>\n</merge>\n'
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            _merge_sources_for_directory(root, 'main')
+
+            with open(os.path.join(xml_dir, 'level_0.xml'), 'r') as f:
+                content = f.read()
+                self.assertTrue('android:id="@+id/deepest"' in content)
+                self.assertEqual(content.count('<!-- Start injected content'), depth)
+
+    def test_deep_injections_are_streamed(self):
+        depth = 600
+        files = {
+            f'_level_{n}.xml': f'<merge>\n    <inject src="_level_{n + 1}"/>\n</merge>\n' for n in range(depth)
+        }
+        # Generic and parameterised content are streamed differently from wrapped content.
+        files['_level_0.xml'] = '<Layout>\n    <inject src="_level_1" id="deepest"/>\n</Layout>\n'
+        files['_level_1.xml'] = '<Layout>\n    <inject src="_level_2"/>\n</Layout>\n'
+        files[f'_level_{depth}.xml'] = '<merge>\n    <Constraint android:id="@+id/${id}"/>\n</merge>\n'
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+
+            _merge_source_set(source_set)
+            with open(os.path.join(xml_dir, 'level_0.xml'), 'r') as f:
+                expected = f.read()
+            os.remove(os.path.join(xml_dir, 'level_0.xml'))
+
+            _merge_source_set(source_set, stream=True)
+            with open(os.path.join(xml_dir, 'level_0.xml'), 'r') as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(expected.count('<!-- Start injected content'), depth)
+            self.assertTrue('android:id="@+id/deepest"' in expected)
+
+    def test_cyclic_injections_report_path(self):
+        files = {
+            '_a.xml': '<merge>\n    <inject src="_b"/>\n</merge>\n',
+            '_b.xml': '<merge>\n    <inject src="_c"/>\n</merge>\n',
+            '_c.xml': '<merge>\n    <inject src="_a"/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(root, files)
+            with self.assertRaises(InjectionCycleError) as cm:
+                _merge_sources_for_directory(root, 'main')
+
+        # The cycle may be reported from any starting point, depending on file discovery order.
+        cycle = cm.exception.cycle
+        self.assertEqual(len(cycle), 4)
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertTrue(' -> '.join(cycle) in ' -> '.join(['_a.xml', '_b.xml', '_c.xml'] * 2))
+        self.assertTrue(' -> '.join(cycle) in str(cm.exception))
+
+    def test_merge_is_in_memory(self):
+        source_path = _get_source_path('_example_motion_scene.xml')
+        with open(source_path, 'r') as f:
+            original = f.read()
+
+        _merge_sources_for_directory(EXAMPLE_ROOT_DIR, 'main')
+
+        self.assertFalse(os.path.exists(TEST_TEMP_DIR))
+        with open(source_path, 'r') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_incremental_rebuilds_changed_outputs_only(self):
+        files = {
+            '_scene_one.xml': '<merge>\n    <inject src="_leaf_one"/>\n</merge>\n',
+            '_scene_two.xml': '<merge>\n    <inject src="_leaf_two"/>\n</merge>\n',
+            '_leaf_one.xml': '<merge>\n    <Constraint android:id="@+id/one"/>\n</merge>\n',
+            '_leaf_two.xml': '<merge>\n    <Constraint android:id="@+id/two"/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            output_one = os.path.join(xml_dir, 'scene_one.xml')
+            output_two = os.path.join(xml_dir, 'scene_two.xml')
+
+            _merge_sources_for_directory(root, 'main', incremental=True)
+            with open(os.path.join(root, 'main', CACHE_FILENAME), 'r') as f:
+                manifest = json.load(f)
+            # Each output records a single digest of its inputs rather than every file in its closure.
+            self.assertEqual(
+                {entry['source']: len(entry['inputs']) for entry in manifest['outputs'].values()},
+                {'_scene_one.xml': 40, '_scene_two.xml': 40},
+            )
+
+            # Nothing is written when nothing changed, not even the cache.
+            manifest_path = os.path.join(root, 'main', CACHE_FILENAME)
+            os.utime(manifest_path, (0, 0))
+            _merge_sources_for_directory(root, 'main', incremental=True)
+            self.assertEqual(os.path.getmtime(manifest_path), 0)
+
+            def _mark_outputs():
+                for path in [output_one, output_two]:
+                    os.utime(path, (0, 0))
+
+            _mark_outputs()
+            _write_source_tree(root, {'_leaf_two.xml': '<merge>\n    <Constraint android:id="@+id/changed"/>\n</merge>\n'})
+            _merge_sources_for_directory(root, 'main', incremental=True)
+
+            self.assertEqual(os.path.getmtime(output_one), 0)
+            self.assertNotEqual(os.path.getmtime(output_two), 0)
+            with open(output_two, 'r') as f:
+                self.assertTrue('@+id/changed' in f.read())
+
+            # Outputs that were removed or edited since the last run are rebuilt.
+            _mark_outputs()
+            os.remove(output_one)
+            _merge_sources_for_directory(root, 'main', incremental=True)
+            self.assertTrue(os.path.exists(output_one))
+            self.assertEqual(os.path.getmtime(output_two), 0)
+
+            # Forced rebuilds regenerate everything, but identical outputs are still left untouched.
+            _write_source_tree(root, {'_leaf_one.xml': '<merge>\n    <Constraint android:id="@+id/new"/>\n</merge>\n'})
+            _mark_outputs()
+            _merge_sources_for_directory(root, 'main', incremental=True, force=True)
+            self.assertNotEqual(os.path.getmtime(output_one), 0)
+            self.assertEqual(os.path.getmtime(output_two), 0)
+
+    def test_incremental_rebuilds_outputs_for_another_parser(self):
+        files = {
+            '_scene.xml': '<MotionScene>\n    <inject src="_nested"/>\n</MotionScene>\n',
+            # The regex scanner unwraps up to the first </merge>, the XML parser up to the matching one.
+            '_nested.xml': '<merge>\n    <merge>\n        <Constraint/>\n    </merge>\n    <Layout/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+            _merge_source_set(source_set, incremental=True)
+
+            result = _merge_source_set(source_set, incremental=True, parser='xml')
+            self.assertListEqual(result.written, ['scene.xml'])
+            with open(os.path.join(xml_dir, 'scene.xml'), 'r') as f:
+                self.assertEqual(f.read(), merge(files, parser='xml')['scene.xml'])
+
+    def test_unchanged_outputs_are_not_rewritten(self):
+        result = _merge_sources_for_directory(EXAMPLE_ROOT_DIR, 'main')
+        self.assertEqual(len(result.written), 4)
+        self.assertEqual(len(result.unchanged), 0)
+
+        output_path = _get_xml_path('example_motion_scene.xml')
+        os.utime(output_path, (0, 0))
+
+        result = _merge_sources_for_directory(EXAMPLE_ROOT_DIR, 'main')
+        self.assertEqual(len(result.written), 0)
+        self.assertEqual(len(result.unchanged), 4)
+        self.assertEqual(os.path.getmtime(output_path), 0)
+
+    def test_incremental_removes_outputs_without_source(self):
+        files = {
+            '_scene_one.xml': '<merge>\n    <Constraint android:id="@+id/one"/>\n</merge>\n',
+            '_scene_two.xml': '<merge>\n    <Constraint android:id="@+id/two"/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            _merge_sources_for_directory(root, 'main', incremental=True)
+
+            os.remove(os.path.join(xml_dir, '_scene_two.xml'))
+            result = _merge_sources_for_directory(root, 'main', incremental=True)
+
+            self.assertListEqual(result.removed, ['scene_two.xml'])
+            self.assertListEqual(result.unchanged, ['scene_one.xml'])
+            self.assertFalse(os.path.exists(os.path.join(xml_dir, 'scene_two.xml')))
+
+    def test_outputs_are_removed_with_the_last_source(self):
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, {'_foo.xml': '<merge>\n    <Constraint android:id="@+id/foo"/>\n</merge>\n'})
+            _merge_sources_for_directory(root, 'main')
+
+            os.remove(os.path.join(xml_dir, '_foo.xml'))
+            result = _merge_sources_for_directory(root, 'main')
+
+            self.assertListEqual(result.removed, ['foo.xml'])
+            self.assertListEqual(os.listdir(xml_dir), [])
+
+            # Without a manifest there is nothing to merge.
+            self.assertListEqual(_find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0].filepaths, [])
+            os.remove(os.path.join(root, 'main', CACHE_FILENAME))
+            self.assertListEqual(_find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR), [])
+
+    def test_stale_outputs_are_pruned_using_manifest(self):
+        files = {
+            '_scene_one.xml': '<merge>\n    <Constraint android:id="@+id/one"/>\n</merge>\n',
+            '_scene_two.xml': '<merge>\n    <Constraint android:id="@+id/two"/>\n</merge>\n',
+            '_scene_three.xml': '<merge>\n    <Constraint android:id="@+id/three"/>\n</merge>\n',
+            '_edited.xml': '<merge>\n    <Constraint android:id="@+id/edited"/>\n</merge>\n',
+            'hand_written.xml': '<merge/>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            _merge_sources_for_directory(root, 'main')
+
+            # scene_two is removed, scene_three is now only injected into scene_one,
+            # and edited has been changed by hand since it was generated.
+            os.remove(os.path.join(xml_dir, '_scene_two.xml'))
+            os.remove(os.path.join(xml_dir, '_edited.xml'))
+            _write_source_tree(root, {
+                '_scene_one.xml': '<merge>\n    <inject src="_scene_three"/>\n</merge>\n',
+                'edited.xml': '<merge/>\n',
+            })
+            result = _merge_sources_for_directory(root, 'main')
+
+            self.assertListEqual(sorted(result.removed), ['scene_three.xml', 'scene_two.xml'])
+            self.assertListEqual(
+                sorted(os.listdir(xml_dir)),
+                ['_scene_one.xml', '_scene_three.xml', 'edited.xml', 'hand_written.xml', 'scene_one.xml'],
+            )
+
+    def test_check_reports_stale_outputs_without_writing(self):
+        files = {
+            '_scene_one.xml': '<merge>\n    <inject src="_leaf"/>\n</merge>\n',
+            '_scene_two.xml': '<merge>\n    <Constraint android:id="@+id/two"/>\n</merge>\n',
+            '_leaf.xml': '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+
+            result = _check_source_set(source_set)
+            self.assertDictEqual(result.changes, {'scene_one.xml': 'missing', 'scene_two.xml': 'missing'})
+            self.assertListEqual(sorted(os.listdir(xml_dir)), sorted(files))
+            self.assertFalse(os.path.exists(source_set.cache_path))
+
+            _merge_source_set(source_set)
+            self.assertDictEqual(_check_source_set(source_set).changes, {})
+
+            os.remove(os.path.join(xml_dir, '_scene_two.xml'))
+            _write_source_tree(root, {'_leaf.xml': '<merge>\n    <Constraint android:id="@+id/changed"/>\n</merge>\n'})
+            snapshot = {x: os.path.getmtime(os.path.join(xml_dir, x)) for x in os.listdir(xml_dir)}
+
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+            result = _check_source_set(source_set)
+            self.assertDictEqual(result.changes, {'scene_one.xml': '+1 -1 lines', 'scene_two.xml': 'no longer generated'})
+            self.assertDictEqual({x: os.path.getmtime(os.path.join(xml_dir, x)) for x in os.listdir(xml_dir)}, snapshot)
+
+    def test_merge_qualifiers_with_overrides(self):
+        files = {
+            '_scene.xml': '<MotionScene>\n    <inject src="_constraints"/>\n    <inject src="_leaf"/>\n</MotionScene>\n',
+            '_other.xml': '<MotionScene>\n    <inject src="_leaf"/>\n</MotionScene>\n',
+            '_constraints.xml': '<merge>\n    <Constraint android:id="@+id/portrait"/>\n</merge>\n',
+            '_leaf.xml': '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n',
+        }
+        land = {'_constraints.xml': '<merge>\n    <Constraint android:id="@+id/land"/>\n</merge>\n'}
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            land_dir = os.path.join(os.path.dirname(xml_dir), 'xml-land')
+            sw600dp_dir = os.path.join(os.path.dirname(xml_dir), 'xml-sw600dp')
+            os.makedirs(land_dir)
+            for filename, content in land.items():
+                with open(os.path.join(land_dir, filename), 'w') as f:
+                    f.write(content)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+
+            # Each source file is only scanned once, however many qualifiers use it.
+            with mock.patch.object(scenemerge, '_scan', wraps=_scan) as scan:
+                result = _merge_source_set(source_set, qualifiers=['land', 'sw600dp'])
+            self.assertEqual(scan.call_count, len(files) + len(land))
+
+            self.assertListEqual(sorted(result.written), [
+                'other.xml',
+                'scene.xml',
+                'xml-land/other.xml',
+                'xml-land/scene.xml',
+                'xml-sw600dp/other.xml',
+                'xml-sw600dp/scene.xml',
+            ])
+            outputs = {}
+            for directory in [xml_dir, land_dir, sw600dp_dir]:
+                for filename in ['scene.xml', 'other.xml']:
+                    with open(os.path.join(directory, filename), 'r') as f:
+                        outputs[os.path.basename(directory), filename] = f.read()
+
+            self.assertTrue('@+id/portrait' in outputs['xml', 'scene.xml'])
+            self.assertTrue('@+id/land' in outputs['xml-land', 'scene.xml'])
+            self.assertEqual(outputs['xml-sw600dp', 'scene.xml'], outputs['xml', 'scene.xml'])
+            self.assertEqual(outputs['xml-land', 'other.xml'], outputs['xml', 'other.xml'])
+            self.assertTrue(os.path.exists(source_set.get_cache_path('land')))
+
+            with open(os.path.join(land_dir, '_constraints.xml'), 'w') as f:
+                f.write('<merge>\n    <Constraint android:id="@+id/changed"/>\n</merge>\n')
+            result = _check_source_set(source_set, qualifiers=['land', 'sw600dp'])
+            self.assertDictEqual(result.changes, {'xml-land/scene.xml': '+1 -1 lines'})
+
+    def test_report(self):
+        files = {
+            '_scene.xml': '<merge>\n    <inject src="_group"/>\n</merge>\n',
+            '_group.xml': '<merge>\n    <inject src="_leaf"/>\n</merge>\n',
+            '_leaf.xml': '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n',
+            '_other.xml': '<merge>\n    <Constraint android:id="@+id/other"/>\n</merge>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+            result = _merge_source_set(source_set, incremental=True, report=True)
+
+            record = result.records['scene.xml']
+            self.assertEqual(record['path'], os.path.join(xml_dir, 'scene.xml'))
+            self.assertEqual(record['source'], os.path.join(xml_dir, '_scene.xml'))
+            self.assertListEqual(record['dependencies'], [
+                os.path.join(xml_dir, '_leaf.xml'),
+                os.path.join(xml_dir, '_group.xml'),
+            ])
+            self.assertEqual(record['bytes'], os.path.getsize(record['path']))
+            self.assertEqual(record['status'], 'written')
+
+            os.remove(os.path.join(xml_dir, '_other.xml'))
+            argv = ['scenemerge', root, '--incremental', '--report', 'json', '--stats', 'json']
+            with mock.patch.object(sys, 'argv', argv):
+                out, err = io.StringIO(), io.StringIO()
+                with redirect_stdout(out), redirect_stderr(err):
+                    scenemerge.main()
+
+            # Stats are printed to stderr so that stdout is only the report.
+            self.assertTrue('phases' in json.loads(err.getvalue()))
+            report = json.loads(out.getvalue())
+            self.assertListEqual(
+                [(x['output'], x['status']) for x in report[0]['outputs']],
+                [('other.xml', 'removed'), ('scene.xml', 'skipped')],
+            )
+            self.assertIsNone(report[0]['error'])
+
+    def test_find_source_sets_per_module(self):
+        scene = '<merge>\n    <inject src="_leaf"/>\n</merge>\n'
+        leaf = '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n'
+
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(os.path.join(root, 'app', 'src'), {'_scene.xml': scene, '_leaf.xml': leaf})
+            _write_source_tree(os.path.join(root, 'lib', 'src'), {'_other.xml': scene, '_leaf.xml': leaf})
+            _write_source_tree(os.path.join(root, 'lib', 'src'), {'_debug.xml': leaf}, sourceset='debug')
+
+            source_sets = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)
+            self.assertListEqual(
+                [os.path.relpath(str(x), root) for x in source_sets],
+                [os.path.join('app', 'src', 'main'), os.path.join('lib', 'src', 'main')],
+            )
+            self.assertListEqual([x.name for x in source_sets], ['main', 'main'])
+
+            _merge_sources_for_directory(root, 'main')
+            self.assertTrue(os.path.exists(os.path.join(root, 'app', 'src', 'main', 'res', 'xml', 'scene.xml')))
+            self.assertTrue(os.path.exists(os.path.join(root, 'lib', 'src', 'main', 'res', 'xml', 'other.xml')))
+            self.assertFalse(os.path.exists(os.path.join(root, 'app', 'src', 'main', 'res', 'xml', 'other.xml')))
+
+    def test_parallel_merge_reports_errors_per_source_set(self):
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(os.path.join(root, 'one'), {'_a.xml': '<merge>\n    <inject src="_a"/>\n</merge>\n'})
+            _write_source_tree(os.path.join(root, 'two'), {'_b.xml': '<merge>\n    <Constraint/>\n</merge>\n'})
+            _write_source_tree(os.path.join(root, 'three'), {'_c.xml': '<merge>\n    <inject src="_missing"/>\n</merge>\n'})
+
+            source_sets = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)
+            results = {
+                os.path.relpath(str(source_set), root): (result, error)
+                for source_set, result, error in _merge_source_sets(source_sets, jobs=3)
+            }
+
+            self.assertTrue(results[os.path.join('one', 'main')][1].startswith('InjectionCycleError'))
+            self.assertTrue(results[os.path.join('three', 'main')][1].startswith('KeyError'))
+            result, error = results[os.path.join('two', 'main')]
+            self.assertIsNone(error)
+            self.assertListEqual(result.written, ['b.xml'])
+
+    def test_parse_qualifiers(self):
+        self.assertListEqual(_parse_qualifiers('land, -sw600dp,land'), ['land', 'sw600dp'])
+        with self.assertRaises(Exception):
+            _parse_qualifiers('land/v31')
+
+    def test_parse_sourcesets(self):
+        self.assertListEqual(_parse_sourcesets('main,debug'), ['main', 'debug'])
+        with self.assertRaises(Exception):
+            _parse_sourcesets('main,release')
+
+    def test_find_source_sets_prunes_excluded_directories(self):
+        leaf = '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n'
+
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(os.path.join(root, 'app', 'src'), {'_scene.xml': leaf})
+            _write_source_tree(os.path.join(root, 'app', 'src'), {'_scene.xml': leaf}, sourceset='debug')
+            _write_source_tree(os.path.join(root, 'app', 'build', 'intermediates'), {'_scene.xml': leaf})
+            _write_source_tree(os.path.join(root, '.git', 'modules'), {'_scene.xml': leaf})
+            _write_source_tree(os.path.join(root, 'legacy', 'src'), {'_scene.xml': leaf})
+
+            def _found(sourcesets, exclude=None):
+                return [
+                    os.path.relpath(str(x), root)
+                    for x in _find_source_sets(root, sourcesets, DEFAULT_SOURCE_RES_DIR, exclude)
+                ]
+
+            self.assertListEqual(
+                _found(['main']),
+                [os.path.join('app', 'src', 'main'), os.path.join('legacy', 'src', 'main')],
+            )
+            self.assertListEqual(
+                _found(['main', 'debug'], exclude=['legacy']),
+                [os.path.join('app', 'src', 'debug'), os.path.join('app', 'src', 'main')],
+            )
+            self.assertListEqual(_found(['main'], exclude=['app/src']), [os.path.join('legacy', 'src', 'main')])
+
+    def test_scan_wrapped_content(self):
+        text = '<?xml version="1.0"?>\n<MotionScene\n    a="1">\n  <inject src="x"/>\n</MotionScene>\n'
+        result = _scan(text)
+        self.assertEqual(text[result.wrapped[0]:result.wrapped[1]], '\n  <inject src="x"/>\n')
+        self.assertEqual(len(result.tags), 1)
+        self.assertEqual(text[result.tags[0].start:result.tags[0].end], '  <inject src="x"/>')
+
+        # Earlier entries in UNWRAP_TAGS take priority.
+        result = _scan('<merge><MotionScene>inner</MotionScene></merge>')
+        self.assertEqual(result.wrapped, (20, 25))
+
+        self.assertIsNone(_scan('<ConstraintSet/>').wrapped)
+
+    def test_shared_source_is_scanned_once(self):
+        parents = 20
+        files = {
+            f'_scene_{n}.xml': '<merge>\n    <inject src="_shared"/>\n</merge>\n' for n in range(parents)
+        }
+        files['_shared.xml'] = '<merge>\n    <Constraint android:id="@+id/shared"/>\n</merge>\n'
+
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(root, files)
+            with mock.patch.object(scenemerge, '_scan', wraps=_scan) as scan:
+                _merge_sources_for_directory(root, 'main')
+
+            self.assertEqual(scan.call_count, len(files))
+
+    def test_each_injection_keeps_its_own_indent(self):
+        files = {
+            '_scene.xml': '<merge>\n<inject src="_leaf"/>\n    <inject src="_leaf"/>\n</merge>\n',
+            '_leaf.xml': '<Constraint\n    android:id="@+id/leaf"/>\n',
+        }
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_files = [SourceFile(os.path.join(xml_dir, x)) for x in sorted(files)]
+            sources = _build_sourcemap(source_files)
+            sources['xml/_leaf.xml'].resolve_injections(sources)
+            sources['xml/_scene.xml'].resolve_injections(sources)
+
+        scene = sources['xml/_scene.xml']
+        self.assertTrue('\n<Constraint\n    android:id="@+id/leaf"/>\n' in scene.text)
+        self.assertTrue('\n    <Constraint\n        android:id="@+id/leaf"/>\n' in scene.text)
+
+        # Position of the wrapped content is carried over from the original text.
+        self.assertEqual(scene.get_wrapped_content(), _get_wrapped_content(scene.text))
+
+    def test_shared_fragment_rendered_once_per_indent(self):
+        files = {
+            '_a.xml': '<merge>\n    <inject src="_leaf"/>\n</merge>\n',
+            '_b.xml': '<merge>\n    <inject src="_leaf"/>\n        <inject src="_leaf"/>\n</merge>\n',
+            '_leaf.xml': '<Constraint android:id="@+id/leaf"/>\n',
+        }
+
+        scenemerge._fragment_cache.clear()
+        with tempfile.TemporaryDirectory() as root:
+            _write_source_tree(root, files)
+            with mock.patch.object(scenemerge, '_get_generic_content', wraps=_get_generic_content) as render:
+                _merge_sources_for_directory(root, 'main')
+
+        # Rendered once at indent 4 and once at indent 8.
+        self.assertEqual(render.call_count, 2)
+
+    def test_fragment_cache_evicts_least_recently_used(self):
+        cache = FragmentCache(max_size=10)
+        cache.put(('a',), 'aaaa')
+        cache.put(('b',), 'bbbb')
+        cache.get(('a',))
+        cache.put(('c',), 'cccc')
+
+        self.assertEqual(cache.get(('a',)), 'aaaa')
+        self.assertIsNone(cache.get(('b',)))
+        self.assertEqual(cache.get(('c',)), 'cccc')
+        self.assertEqual(cache.size, 8)
+
+        # Too large to cache at all.
+        cache.put(('d',), 'd' * 11)
+        self.assertIsNone(cache.get(('d',)))
+        self.assertEqual(len(cache), 2)
+
+    def test_streamed_outputs_match_in_memory_outputs(self):
+        def _read_outputs(xml_dir):
+            outputs = {}
+            for filename in os.listdir(xml_dir):
+                if filename not in TEST_FILES:
+                    with open(os.path.join(xml_dir, filename), 'r') as f:
+                        outputs[filename] = f.read()
+            return outputs
+
+        with tempfile.TemporaryDirectory() as root:
+            shutil.copytree(EXAMPLE_ROOT_DIR, root, dirs_exist_ok=True)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+
+            _merge_source_set(source_set, keep_transitive=True)
+            expected = _read_outputs(source_set.output_dir)
+            for filename in expected:
+                os.remove(os.path.join(source_set.output_dir, filename))
+
+            result = _merge_source_set(source_set, keep_transitive=True, stream=True)
+            self.assertEqual(len(result.written), len(expected))
+            self.assertEqual(_read_outputs(source_set.output_dir), expected)
+
+            result = _merge_source_set(source_set, keep_transitive=True, stream=True)
+            self.assertEqual(len(result.unchanged), len(expected))
+            self.assertEqual(result.written, [])
+
+    def test_generic_content_strips_ignored_lines(self):
+        text = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ConstraintSet xmlns:android="http://schemas.android.com/apk/res/android"\n'
+            '    xmlns:motion="http://schemas.android.com/apk/res-auto">\n'
+            '\n'
+            '    <Constraint android:id="@+id/a"/>\n'
+            '</ConstraintSet>'
+        )
+
+        self.assertEqual(
+            _get_generic_content(text, 2),
+            '  <ConstraintSet'
+            '  >'
+            '  \n'
+            '      <Constraint android:id="@+id/a"/>\n'
+            '  </ConstraintSet>',
+        )
+        self.assertEqual(_get_generic_content('', 4), '')
+        self.assertEqual(_get_generic_content('a\n\nb\n', 1), ' a\n \n b\n')
+
+    def test_parameterised_injections(self):
+        files = {
+            '_scene.xml': (
+                '<MotionScene>\n'
+                '    <inject src="_transition" id="one" duration="100"/>\n'
+                '    <inject src="_transition" id="two" duration="200"/>\n'
+                '    <inject src="_group" id="three"/>\n'
+                '</MotionScene>\n'
+            ),
+            '_group.xml': '<merge>\n    <inject src="_transition" duration="300"/>\n</merge>\n',
+            '_transition.xml': (
+                '<Transition\n'
+                '    android:id="@+id/${id}"\n'
+                '    motion:duration="${duration}"\n'
+                '    motion:staggered="${stagger}"/>\n'
+            ),
+        }
+
+        expected = [
+            '        android:id="@+id/one"\n        motion:duration="100"\n',
+            '        android:id="@+id/two"\n        motion:duration="200"\n',
+            '        android:id="@+id/three"\n        motion:duration="300"\n',
+        ]
+        outputs = {}
+        for parser in PARSERS:
+            # Each parser must render the fragments itself for the outputs to be compared.
+            scenemerge._fragment_cache.clear()
+            outputs[parser] = merge(files, parser=parser)
+
+        for parser, output in outputs.items():
+            content = output['scene.xml']
+            for variant in expected:
+                self.assertTrue(variant in content, parser)
+            # Placeholders without a value are left as they are.
+            self.assertEqual(content.count('motion:staggered="${stagger}"'), 3)
+        self.assertEqual(outputs['regex'], outputs['xml'])
+
+        with tempfile.TemporaryDirectory() as root:
+            xml_dir = _write_source_tree(root, files)
+            source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+            _merge_source_set(source_set, stream=True)
+            with open(os.path.join(xml_dir, 'scene.xml'), 'r') as f:
+                self.assertEqual(f.read(), outputs['regex']['scene.xml'])
+
+    def test_fragment_cache_is_separate_for_each_parser(self):
+        files = {
+            '_scene.xml': '<MotionScene>\n    <inject src="_nested"/>\n</MotionScene>\n',
+            # The regex scanner unwraps up to the first </merge>, the XML parser up to the matching one.
+            '_nested.xml': '<merge>\n    <merge>\n        <Constraint/>\n    </merge>\n    <Layout/>\n</merge>\n',
+        }
+
+        scenemerge._fragment_cache.clear()
+        expected = merge(files, parser='regex')
+        scenemerge._fragment_cache.clear()
+        self.assertNotEqual(merge(files, parser='xml'), expected)
+        self.assertEqual(merge(files, parser='regex'), expected)
+
+    def test_template_render(self):
+        template = Template('<Constraint android:id="@+id/${id}" android:alpha="${alpha}"/>')
+        self.assertEqual(template.segments[1::2], ['id', 'alpha'])
+        self.assertEqual(template.render({'id': 'a', 'alpha': '0.5'}), '<Constraint android:id="@+id/a" android:alpha="0.5"/>')
+        self.assertEqual(template.render({'id': 'a'}), '<Constraint android:id="@+id/a" android:alpha="${alpha}"/>')
+        self.assertEqual(template.render(), template.text)
+
+    def test_source_graph_with_shared_dependencies(self):
+        # Diamond: both branches inject the same leaf, which the scene therefore includes four times.
+        files = {
+            'xml/_scene.xml': '<merge>\n    <inject src="_left"/>\n    <inject src="_right"/>\n</merge>\n',
+            'xml/_left.xml': '<merge>\n    <inject src="_leaf"/>\n    <inject src="_leaf"/>\n</merge>\n',
+            'xml/_right.xml': '<merge>\n    <inject src="_leaf"/>\n    <inject src="_leaf"/>\n</merge>\n',
+            'xml/_leaf.xml': '<Constraint android:id="@+id/leaf"/>\n',
+            'xml-land/_leaf.xml': '<Constraint android:id="@+id/land"/>\n',
+        }
+        graph = SourceGraph(_build_sourcemap(SourceFile(path, text) for path, text in files.items()))
+        ids = graph.ids
+
+        self.assertTupleEqual(graph.injects[ids['xml/_left.xml']], (ids['xml/_leaf.xml'],))
+        self.assertListEqual(graph.injected_by[ids['xml/_leaf.xml']], [ids['xml/_left.xml'], ids['xml/_right.xml']])
+        self.assertListEqual(graph.injected_by[ids['xml-land/_leaf.xml']], [])
+
+        order = [graph.keys[i] for i in graph.order()]
+        self.assertListEqual(order[:4], ['xml/_leaf.xml', 'xml/_left.xml', 'xml/_right.xml', 'xml/_scene.xml'])
+
+        self.assertSetEqual(graph.closure([ids['xml/_scene.xml']]), graph.get_ids(list(files)[:4]))
+        self.assertSetEqual(graph.dependents([ids['xml/_leaf.xml']]), graph.get_ids(list(files)[:4]))
+
+        with self.assertRaises(AttributeError):
+            graph.files[0].dependencies = []
+
+    def test_source_graph_missing_source(self):
+        files = {'xml/_scene.xml': '<merge>\n    <inject src="_missing"/>\n</merge>\n'}
+        graph = SourceGraph(_build_sourcemap(SourceFile(path, text) for path, text in files.items()))
+
+        # Missing files are part of the graph but cannot be ordered.
+        self.assertSetEqual(graph.dependents(graph.get_ids(['xml/_missing.xml'])), {0, 1})
+        with self.assertRaises(KeyError):
+            graph.order()
+
+    def test_import_is_lightweight(self):
+        # The console script runs on every save, so modules which are only needed in some runs are imported lazily.
+        lazy_modules = ['argparse', 'concurrent.futures.process', 'difflib', 'tempfile']
+        code = (
+            'import logging, sys, motionscene_merger.scenemerge; '
+            f'print(sorted(set(sys.modules) & set({lazy_modules!r}))); '
+            'print(logging.getLogger("motionscene_merger.scenemerge").handlers)'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+        self.assertEqual(output, '[]\n[]\n')
+
+    def test_run_as_module(self):
+        for module in ['motionscene_merger', 'motionscene_merger.scenemerge']:
+            process = subprocess.run(
+                # Importing the package must not import scenemerge before runpy executes it.
+                [sys.executable, '-W', 'error', '-m', module, '--help'],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(process.returncode, 0, process.stderr)
+            self.assertEqual(process.stderr, '')
+            self.assertTrue('--incremental' in process.stdout)
@@ -0,0 +1,59 @@
+"""
+
+"""
+
+import json
+import os
+from unittest import TestCase
+
+from motionscene_merger import stats
+from motionscene_merger.scenemerge import CACHE_FILENAME, _merge_sources_for_directory
+from motionscene_merger.stats import RunStats
+
+EXAMPLE_ROOT_DIR = os.path.join(os.path.dirname(__file__), 'example_root_dir')
+TEST_XML_DIR = os.path.join(EXAMPLE_ROOT_DIR, 'main', 'res', 'xml')
+MANIFEST_PATH = os.path.join(EXAMPLE_ROOT_DIR, 'main', CACHE_FILENAME)
+
+
+class StatsTestCase(TestCase):
+    def tearDown(self) -> None:
+        for f in os.listdir(TEST_XML_DIR):
+            if not f.startswith('_') and f != 'some_other_file.xml':
+                os.remove(os.path.join(TEST_XML_DIR, f))
+        if os.path.exists(MANIFEST_PATH):
+            os.remove(MANIFEST_PATH)
+
+    def test_merge_records_stats(self):
+        with stats.collect() as run_stats:
+            _merge_sources_for_directory(EXAMPLE_ROOT_DIR, 'main')
+
+        self.assertListEqual(list(run_stats.phases), ['discovery', 'load', 'cache', 'graph', 'resolve', 'write'])
+        self.assertEqual(run_stats.counters['passes'], 1)
+        self.assertEqual(run_stats.counters['files_resolved'], 9)
+        self.assertEqual(run_stats.counters['tags_expanded'], 5)
+        self.assertEqual(run_stats.counters['file_opens'], 9 + 4 + 1)  # Read sources, write outputs and manifest.
+        self.assertTrue(run_stats.counters['bytes_written'] > 0)
+        self.assertEqual(len(run_stats.slowest_files()), 9)
+
+        # Stats are not added to the enclosing RunStats.
+        self.assertFalse(run_stats is stats.current())
+
+    def test_merge_and_report(self):
+        one = RunStats()
+        one.count('tags_expanded', 2)
+        one.time_file('_a.xml', 0.5)
+        with one.phase('resolve'):
+            pass
+
+        two = RunStats()
+        two.count('tags_expanded', 3)
+        two.time_file('_b.xml', 1.5)
+
+        one.merge(two)
+        self.assertEqual(one.counters['tags_expanded'], 5)
+        self.assertEqual(one.slowest_files(1), [('_b.xml', 1.5)])
+
+        report = json.loads(one.to_json())
+        self.assertListEqual(list(report['phases']), ['resolve'])
+        self.assertEqual(report['slowest_files'][0]['path'], '_b.xml')
+        self.assertTrue('tags_expanded' in one.to_table())
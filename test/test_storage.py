@@ -0,0 +1,151 @@
+"""
+
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock, skipIf
+
+import motionscene_merger
+from motionscene_merger import stats, storage
+from motionscene_merger.scenemerge import (
+    CACHE_FILENAME,
+    SourceSet,
+    _merge_source_set,
+)
+from motionscene_merger.storage import FileStorage, MemoryStorage
+
+SCENE = '''<?xml version="1.0" encoding="utf-8"?>
+<MotionScene xmlns:android="http://schemas.android.com/apk/res/android">
+    <inject src="_constraints"/>
+</MotionScene>
+'''
+CONSTRAINTS = '''<merge>
+    <ConstraintSet android:id="@+id/start"/>
+</merge>
+'''
+
+
+class StorageTestCase(TestCase):
+    def test_merge_in_memory(self):
+        with mock.patch('builtins.open', side_effect=AssertionError('File opened')):
+            outputs = motionscene_merger.merge({
+                '_scene.xml': SCENE,
+                '_constraints.xml': CONSTRAINTS,
+            })
+
+        self.assertListEqual(list(outputs), ['scene.xml'])
+        self.assertTrue('<ConstraintSet android:id="@+id/start"/>' in outputs['scene.xml'])
+        self.assertTrue("You should edit the source file '_scene.xml' instead." in outputs['scene.xml'])
+
+        # Storage is restored afterwards.
+        self.assertTrue(isinstance(storage.current(), storage.FileStorage))
+
+    def test_concurrent_merges(self):
+        errors = []
+
+        def _merge(thread: int):
+            for i in range(20):
+                leaf = CONSTRAINTS.replace('@+id/start', f'@+id/t{thread}_{i}')
+                try:
+                    outputs = motionscene_merger.merge({
+                        f'_scene_{thread}.xml': SCENE,
+                        '_constraints.xml': leaf,
+                    })
+                    self.assertListEqual(list(outputs), [f'scene_{thread}.xml'])
+                    self.assertTrue(f'@+id/t{thread}_{i}' in outputs[f'scene_{thread}.xml'])
+                except Exception as e:
+                    errors.append(e)
+
+        with tempfile.TemporaryDirectory() as d:
+            cwd = os.getcwd()
+            os.chdir(d)
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)  # Switch threads as often as possible.
+            try:
+                threads = [threading.Thread(target=_merge, args=[n]) for n in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                sys.setswitchinterval(interval)
+                os.chdir(cwd)
+
+            self.assertListEqual(errors, [])
+            self.assertListEqual(os.listdir(d), [])
+        self.assertTrue(isinstance(storage.current(), storage.FileStorage))
+
+    def test_merge_missing_source(self):
+        with self.assertRaises(KeyError):
+            motionscene_merger.merge({'_scene.xml': SCENE})
+
+    def test_incremental_merge_with_memory_storage(self):
+        xml_dir = os.path.join('app', 'src', 'main', 'res', 'xml')
+        scene_path = os.path.join(xml_dir, '_scene.xml')
+        files = {
+            scene_path: SCENE,
+            os.path.join(xml_dir, '_constraints.xml'): CONSTRAINTS,
+        }
+        source_set = SourceSet(os.path.dirname(xml_dir), sorted(files))
+
+        with storage.use(MemoryStorage(files)) as memory:
+            result = _merge_source_set(source_set, incremental=True)
+            self.assertListEqual(result.written, ['scene.xml'])
+            self.assertTrue(os.path.join('app', 'src', 'main', CACHE_FILENAME) in memory.files)
+
+            result = _merge_source_set(source_set, incremental=True)
+            self.assertListEqual(result.unchanged, ['scene.xml'])
+
+            memory.files[scene_path] = SCENE.replace('<MotionScene', '<MotionScene motion:defaultDuration="100"')
+            result = _merge_source_set(source_set, incremental=True)
+            self.assertListEqual(result.written, ['scene.xml'])
+            self.assertTrue('defaultDuration' in memory.files[os.path.join(xml_dir, 'scene.xml')])
+
+    def test_memory_storage_missing_file(self):
+        memory = MemoryStorage()
+        with self.assertRaises(FileNotFoundError):
+            memory.read('missing.xml')
+        with self.assertRaises(FileNotFoundError):
+            memory.remove('missing.xml')
+
+    def test_file_storage_write_is_atomic(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'scene.xml')
+            FileStorage().write(path, 'original')
+
+            with mock.patch('os.replace', side_effect=OSError('Interrupted')):
+                with self.assertRaises(OSError):
+                    FileStorage().write(path, 'updated')
+
+            with open(path, 'r') as f:
+                self.assertEqual(f.read(), 'original')
+            self.assertListEqual(os.listdir(d), ['scene.xml'])
+
+    @skipIf(storage.fcntl is None, 'flock() not available')
+    def test_file_storage_lock_serialises_writers(self):
+        events = []
+        other_stats = []
+
+        def _write(name: str):
+            # Stats are recorded separately for each thread.
+            with stats.collect() as run_stats:
+                with FileStorage().lock(d):
+                    events.append(f'{name} start')
+                    time.sleep(0.05)
+                    events.append(f'{name} end')
+            other_stats.append(run_stats)
+
+        with tempfile.TemporaryDirectory() as d:
+            with FileStorage().lock(d):
+                other = threading.Thread(target=_write, args=['other'])
+                other.start()
+                time.sleep(0.05)
+                events.append('first end')
+            other.join()
+
+        self.assertListEqual(events, ['first end', 'other start', 'other end'])
+        self.assertEqual(other_stats[0].counters.get('lock_waits'), 1)
@@ -0,0 +1,83 @@
+"""
+
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from motionscene_merger.scenemerge import _find_source_sets
+from motionscene_merger.watch import (
+    PollingMonitor,
+    WatchSession,
+)
+from test_scenemerge import _write_source_tree
+
+
+SOURCES = {
+    '_scene_one.xml': '<merge>\n    <inject src="_shared"/>\n</merge>\n',
+    '_scene_two.xml': '<merge>\n    <inject src="_shared"/>\n</merge>\n',
+    '_scene_three.xml': '<merge>\n    <inject src="_other"/>\n</merge>\n',
+    '_shared.xml': '<merge>\n    <Constraint android:id="@+id/shared"/>\n</merge>\n',
+    '_other.xml': '<merge>\n    <Constraint android:id="@+id/other"/>\n</merge>\n',
+}
+
+
+class WatchTestCase(TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.xml_dir = _write_source_tree(self.root, SOURCES)
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def _read_output(self, filename: str) -> str:
+        with open(os.path.join(self.xml_dir, filename), 'r') as f:
+            return f.read()
+
+    def test_update_rebuilds_affected_outputs_only(self):
+        session = WatchSession(_find_source_sets(self.root, ['main'], 'xml')[0])
+        result = session.merge_all()
+        self.assertEqual(sorted(result.written), ['scene_one.xml', 'scene_three.xml', 'scene_two.xml'])
+
+        changed = _write_source_tree(self.root, {
+            '_shared.xml': '<merge>\n    <Constraint android:id="@+id/changed"/>\n</merge>\n',
+        })
+        result = session.update({os.path.join(changed, '_shared.xml')})
+
+        self.assertEqual(sorted(result.written), ['scene_one.xml', 'scene_two.xml'])
+        self.assertEqual(result.unchanged, [])
+        self.assertTrue('@+id/changed' in self._read_output('scene_one.xml'))
+        self.assertTrue('@+id/changed' in self._read_output('scene_two.xml'))
+        self.assertTrue('@+id/other' in self._read_output('scene_three.xml'))
+
+    def test_update_ignores_unchanged_content(self):
+        session = WatchSession(_find_source_sets(self.root, ['main'], 'xml')[0])
+        session.merge_all()
+        self.assertIsNone(session.update({os.path.join(self.xml_dir, '_shared.xml')}))
+
+    def test_update_new_injection(self):
+        session = WatchSession(_find_source_sets(self.root, ['main'], 'xml')[0])
+        session.merge_all()
+
+        _write_source_tree(self.root, {
+            '_scene_three.xml': '<merge>\n    <inject src="_other"/>\n    <inject src="_shared"/>\n</merge>\n',
+        })
+        result = session.update({os.path.join(self.xml_dir, '_scene_three.xml')})
+
+        self.assertEqual(result.written, ['scene_three.xml'])
+        content = self._read_output('scene_three.xml')
+        self.assertTrue('@+id/other' in content)
+        self.assertTrue('@+id/shared' in content)
+
+    def test_polling_monitor(self):
+        monitor = PollingMonitor([self.xml_dir])
+        self.assertEqual(monitor.poll(), set())
+
+        path = os.path.join(self.xml_dir, '_other.xml')
+        os.utime(path, (0, 0))
+        _write_source_tree(self.root, {'_new.xml': '<merge/>\n', 'not_a_source.xml': '<merge/>\n'})
+
+        self.assertEqual(monitor.poll(), {path, os.path.join(self.xml_dir, '_new.xml')})
+        self.assertEqual(monitor.poll(), set())
@@ -0,0 +1,74 @@
+"""
+
+"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from motionscene_merger.scenemerge import (
+    DEFAULT_SOURCE_RES_DIR,
+    _find_source_sets,
+    _merge_source_set,
+    merge,
+)
+from motionscene_merger.xmlparser import XmlScanError, scan
+
+EXAMPLE_ROOT_DIR = os.path.join(os.path.dirname(__file__), 'example_root_dir')
+
+
+class XmlParserTestCase(TestCase):
+    def test_outputs_match_regex_parser(self):
+        outputs = {}
+        for parser in ['regex', 'xml']:
+            with tempfile.TemporaryDirectory() as root:
+                shutil.copytree(EXAMPLE_ROOT_DIR, root, dirs_exist_ok=True)
+                source_set = _find_source_sets(root, ['main'], DEFAULT_SOURCE_RES_DIR)[0]
+                result = _merge_source_set(source_set, keep_transitive=True, parser=parser)
+
+                outputs[parser] = {}
+                for filename in result.written:
+                    with open(os.path.join(source_set.output_dir, filename), 'r') as f:
+                        outputs[parser][filename] = f.read()
+
+        self.assertEqual(len(outputs['xml']), 9)
+        self.assertDictEqual(outputs['xml'], outputs['regex'])
+
+    def test_nested_unwrap_tags(self):
+        text = '<merge>\n    <merge>\n        <inject src="_a"/>\n    </merge>\n    <inject src="_b"/>\n</merge>\n'
+        result = scan(text)
+
+        self.assertEqual(text[result.wrapped[0]:result.wrapped[1]], text[7:-9])
+        self.assertListEqual([(t.src, t.indent) for t in result.tags], [('_a.xml', 8), ('_b.xml', 4)])
+        self.assertEqual(result.tags[0].tag, '        <inject src="_a"/>')
+
+    def test_ignores_commented_injections(self):
+        outputs = merge(
+            {
+                '_scene.xml': (
+                    '<merge>\n'
+                    '    <!--\n'
+                    '    <inject src="_missing"/>\n'
+                    '    -->\n'
+                    '    <!-- <inject src="_missing"/> --><inject src="_leaf"/>\n'
+                    '</merge>\n'
+                ),
+                '_leaf.xml': '<merge>\n    <Constraint android:id="@+id/leaf"/>\n</merge>\n',
+            },
+            parser='xml',
+        )
+
+        self.assertTrue('<!-- <inject src="_missing"/> --><!-- Start injected content' in outputs['scene.xml'])
+        self.assertTrue('@+id/leaf' in outputs['scene.xml'])
+
+    def test_non_ascii_offsets(self):
+        text = '<merge>\n    <!-- é -->\n    <inject src="_ü"/>\n</merge>\n'
+        result = scan(text)
+        self.assertEqual(text[result.tags[0].start:result.tags[0].end], '    <inject src="_ü"/>')
+        self.assertEqual(text[result.wrapped[1]:], '</merge>\n')
+
+    def test_invalid_xml(self):
+        with self.assertRaises(XmlScanError) as context:
+            merge({'_scene.xml': '<merge>\n    <inject src="_leaf">\n</merge>\n'}, parser='xml')
+        self.assertTrue(str(context.exception).startswith('_scene.xml: Invalid XML at line 3'))